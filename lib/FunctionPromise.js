@@ -7,60 +7,89 @@
 //
 // Where possible it will arrange for the function body to be parsed/compiled
 // off of the main thread, with the function object returned asynchronously
-// via a promise.  The fallback implementation processes just falls back to
-// the standard synchronous Function() constructor.
-// 
+// via a promise.  In the browser this is done by loading it from a Blob URL
+// with a <script> tag, and in a web worker by loading it with importScripts().
+// In nodejs it's compiled with the "vm" module, which can keep V8's code
+// cache for the function in a file (see FunctionPromise.withOptions below).
+// The fallback implementation processes just falls back to the standard
+// synchronous Function() constructor.
+//
+// The function body may also be given as an array of parts, each either a
+// string or some utf-8 encoded binary data, so that a large function body
+// needn't be built up into one big string.  Where the function is compiled
+// from a Blob, the parts are passed along to it as they are.
+//
 // It doesn't (yet) have the following features from the linked proposal:
 //
 //    * ability to copy to different workers
 //    * ability to store in IndexedDB
-// 
+//
 function FunctionPromise(/* [args1[, args2[, ...argN]],], functionBody) */) {
+  var args = Array.prototype.slice.call(arguments);
+  return FunctionPromise.withOptions.apply(null, [{}].concat(args));
+}
 
-  var useFallback =
-    typeof window === "undefined" ||
-    window.FunctionPromise !== FunctionPromise ||
-    typeof document === "undefined" ||
-    typeof document.createElement === "undefined" ||
-    typeof document.head === "undefined" ||
-    typeof document.head.appendChild === "undefined" ||
-    typeof Blob === "undefined" ||
-    typeof URL === "undefined" ||
-    typeof URL.createObjectURL === "undefined";
+// Like FunctionPromise, but taking an extra first argument of options:
+//
+//    * cacheFile:  in nodejs, a file in which to keep V8's code cache for the
+//                  function, so that later processes can skip most of the
+//                  work of compiling it.
+//    * filename:   in nodejs, the filename to show in stack traces.
+//
+FunctionPromise.withOptions = function(opts /*, [args...], functionBody */) {
+  var args = Array.prototype.slice.call(arguments, 1);
+  var haveBlobURLs =
+    typeof Blob !== "undefined" &&
+    typeof URL !== "undefined" &&
+    typeof URL.createObjectURL !== "undefined";
 
-  var args = Array.prototype.slice.call(arguments);
+  // In the browser, we can do this asynchronously
+  // by writing a <script> tag into the DOM.
 
-  // For the fallback case, we just use the normal Function constructor.
+  if (haveBlobURLs &&
+      typeof window !== "undefined" &&
+      window.FunctionPromise === FunctionPromise &&
+      typeof document !== "undefined" &&
+      typeof document.createElement !== "undefined" &&
+      typeof document.head !== "undefined" &&
+      typeof document.head.appendChild !== "undefined") {
+    return FunctionPromise._loadScriptTag(args);
+  }
 
-  if (useFallback) {
-    try {
-      var fn = Function.apply(null, args);
-      return Promise.resolve(fn);
-    } catch (err) {
-      return Promise.reject(err);
-    }
+  // In a web worker we're already off the main thread,
+  // but importScripts() lets the browser compile it as a script.
+
+  if (haveBlobURLs &&
+      typeof importScripts === "function" &&
+      typeof self !== "undefined" &&
+      self.FunctionPromise === FunctionPromise) {
+    return FunctionPromise._importScripts(args);
   }
 
-  // If we have all the necessary pieces, we can do this asynchronously
-  // by writing a <script> tag into the DOM.
+  // In nodejs, we can use the "vm" module and V8's code cache.
 
-  var funcid = FunctionPromise._nextid++;
+  if (typeof process !== "undefined" &&
+      process.versions && process.versions.node &&
+      typeof require === "function") {
+    return FunctionPromise._compileNodeScript(args, opts || {});
+  }
+
+  // For the fallback case, we just use the normal Function constructor.
 
+  try {
+    var fn = Function.apply(null, FunctionPromise._joinArgs(args));
+    return Promise.resolve(fn);
+  } catch (err) {
+    return Promise.reject(err);
+  }
+}
+
+FunctionPromise._loadScriptTag = function(args) {
+  var funcid = FunctionPromise._nextid++;
   return new Promise(function(resolve, reject) {
     try {
-      var funcSrc = [];
-      funcSrc.push("window.FunctionPromise._results[" + funcid + "]=");
-      funcSrc.push("function(");
-      if (args.length > 1) {
-        funcSrc.push(args[0]);
-        for (var i = 1; i < args.length - 1; i++) {
-          funcSrc.push(",");
-          funcSrc.push(args[i]);
-        }
-      }
-      funcSrc.push("){");
-      funcSrc.push(args[args.length - 1]);
-      funcSrc.push("}");
+      var prefix = "window.FunctionPromise._results[" + funcid + "]=";
+      var funcSrc = FunctionPromise._source(prefix, args);
       var dataUrl = URL.createObjectURL(new Blob(funcSrc));
       var scriptTag = document.createElement("script");
       var cleanup = function() {
@@ -80,7 +109,7 @@ function FunctionPromise(/* [args1[, args2[, ...argN]],], functionBody) */) {
           // Likely a syntax error in the function body string.
           // Fall back to Function() constructor to surface it.
           try {
-            Function.apply(null, args);
+            Function.apply(null, FunctionPromise._joinArgs(args));
             reject(new Error("unknown error fulfilling FunctionPromise"));
           } catch (err) {
             reject(err);
@@ -96,9 +125,142 @@ function FunctionPromise(/* [args1[, args2[, ...argN]],], functionBody) */) {
   });
 }
 
+FunctionPromise._importScripts = function(args) {
+  var funcid = FunctionPromise._nextid++;
+  return new Promise(function(resolve, reject) {
+    var prefix = "self.FunctionPromise._results[" + funcid + "]=";
+    var funcSrc = FunctionPromise._source(prefix, args);
+    var dataUrl = URL.createObjectURL(new Blob(funcSrc));
+    try {
+      importScripts(dataUrl);
+      if (self.FunctionPromise._results[funcid]) {
+        resolve(self.FunctionPromise._results[funcid]);
+      } else {
+        reject(new Error("unknown error fulfilling FunctionPromise"));
+      }
+    } catch (err) {
+      reject(err);
+    }
+    URL.revokeObjectURL(dataUrl);
+    delete self.FunctionPromise._results[funcid];
+  });
+}
+
+FunctionPromise._compileNodeScript = function(args, opts) {
+  var vm = require("vm");
+  var fs = require("fs");
+  var funcSrc = FunctionPromise._source("(", args);
+  for (var i = 0; i < funcSrc.length; i++) {
+    funcSrc[i] = FunctionPromise._decode(funcSrc[i]);
+  }
+  funcSrc.push(")");
+  var cachedData = undefined;
+  if (opts.cacheFile) {
+    try {
+      cachedData = fs.readFileSync(opts.cacheFile);
+    } catch (err) { }
+  }
+  try {
+    var script = new vm.Script(funcSrc.join(""), {
+      filename: opts.filename || "FunctionPromise",
+      cachedData: cachedData
+    });
+    var fn = script.runInThisContext();
+  } catch (err) {
+    return Promise.reject(err);
+  }
+  if (!opts.cacheFile || typeof script.createCachedData !== "function") {
+    return Promise.resolve(fn);
+  }
+  if (cachedData && !script.cachedDataRejected) {
+    return Promise.resolve(fn);
+  }
+  // Write out a new code cache once the function has been run for the
+  // first time, so that it also covers any code compiled lazily.
+  var cacheWritten = false;
+  return Promise.resolve(function() {
+    var result = fn.apply(this, arguments);
+    if (!cacheWritten) {
+      cacheWritten = true;
+      setImmediate(function() {
+        var tmpFile = opts.cacheFile + "." + process.pid + ".tmp";
+        try {
+          fs.writeFileSync(tmpFile, script.createCachedData());
+          fs.renameSync(tmpFile, opts.cacheFile);
+        } catch (err) {
+          try {
+            fs.unlinkSync(tmpFile);
+          } catch (err) { }
+        }
+      });
+    }
+    return result;
+  });
+}
+
 FunctionPromise._nextid = 0;
 FunctionPromise._results = {};
 
+// Build the source of a function expression from its arguments and body,
+// as a list of parts following the given prefix.
+FunctionPromise._source = function(prefix, args) {
+  var funcSrc = [];
+  funcSrc.push(prefix);
+  funcSrc.push("function(");
+  if (args.length > 1) {
+    funcSrc.push(args[0]);
+    for (var i = 1; i < args.length - 1; i++) {
+      funcSrc.push(",");
+      funcSrc.push(args[i]);
+    }
+  }
+  funcSrc.push("){");
+  var body = args[args.length - 1];
+  if (!Array.isArray(body)) {
+    body = [body];
+  }
+  for (var i = 0; i < body.length; i++) {
+    funcSrc.push(body[i]);
+  }
+  funcSrc.push("\n}");
+  return funcSrc;
+}
+
+// Join the parts of a function body into a single string,
+// for passing to the Function constructor.
+FunctionPromise._joinArgs = function(args) {
+  var body = args[args.length - 1];
+  if (!Array.isArray(body)) {
+    return args;
+  }
+  var parts = [];
+  for (var i = 0; i < body.length; i++) {
+    parts.push(FunctionPromise._decode(body[i]));
+  }
+  return args.slice(0, -1).concat([parts.join("")]);
+}
+
+FunctionPromise._decode = function(data) {
+  if (typeof data === "string") {
+    return data;
+  }
+  var bytes = data instanceof ArrayBuffer ? new Uint8Array(data) :
+              new Uint8Array(data.buffer, data.byteOffset, data.byteLength);
+  if (typeof TextDecoder !== "undefined") {
+    return new TextDecoder("utf-8").decode(bytes);
+  }
+  if (typeof Buffer !== "undefined") {
+    return Buffer.from(bytes.buffer, bytes.byteOffset, bytes.length).toString("utf-8");
+  }
+  // Otherwise decode it by hand, a chunk at a time.
+  var chunks = [];
+  for (var i = 0; i < bytes.length; i += 8192) {
+    var chunk = String.fromCharCode.apply(null, bytes.subarray(i, i + 8192));
+    chunks.push(chunk);
+  }
+  return decodeURIComponent(escape(chunks.join("")));
+}
+
 if (typeof module !== "undefined" && typeof module.exports !== "undefined") {
   if (typeof Promise === "undefined") {
     Promise = require("./Promise.min.js");
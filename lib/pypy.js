@@ -115,24 +115,22 @@ var devNull = {
 }
 
 
-// Main class representing the PyPy VM.
-// This is our primary export and return value.
-function PyPyJS(opts) {
-
+// Set up the default IO streams for an interpreter object.
+function setDefaultIO(obj) {
   // Default stdin to a closed file.
   // There's no good way to synchronously read stdin in javascript.
   // Calling code may override this to handle stdin.
-  this.stdin = devNull.stdin;
+  obj.stdin = devNull.stdin;
 
   // Default stdout and stderr to process outputs if available, otherwise
   // to /dev/null. Calling code may override these to handle output.
-  this.stdout = this.stderr = null
+  obj.stdout = obj.stderr = null
   if (typeof process !== "undefined") {
     if (typeof process.stdout !== "undefined") {
-      this.stdout = function(x) { process.stdout.write(x); }
+      obj.stdout = function(x) { process.stdout.write(x); }
     }
     if (typeof process.stderr !== "undefined") {
-      this.stderr = function(x) { process.stderr.write(x); }
+      obj.stderr = function(x) { process.stderr.write(x); }
     }
   }
   var _print, _printErr;
@@ -153,60 +151,228 @@ function PyPyJS(opts) {
       _printErr = console.error.bind(console);
     }
   }
+  // print()/console.log() will add a newline, so we buffer until we
+  // receive one and then let it add it for us.
+  var lineBuffered = function(printLine) {
+    var buffer = "";
+    return function(data) {
+      var lines = (buffer + data).split("\n");
+      buffer = lines.pop();
+      for (var i = 0; i < lines.length; i++) {
+        printLine(lines[i]);
+      }
+    }
+  };
   if (typeof _print !== "undefined") {
-    if (this.stdout === null) {
-      // print()/console.log() will add a newline, so we buffer until we
-      // receive one and then let it add it for us.
-      this.stdout = (function() {
-        var buffer = [];
-        return function(data) {
-          for (var i = 0; i < data.length; i++) {
-            var x = data.charAt(i);
-            if (x !== "\n") {
-              buffer.push(x);
-            } else {
-              _print(buffer.join(""));
-              buffer.splice(undefined, buffer.length);
-            }
-          }
-        }
-      })();
+    if (obj.stdout === null) {
+      obj.stdout = lineBuffered(_print);
     }
   }
   if (typeof _printErr !== "undefined") {
-    if (this.stderr === null) {
-      // printErr()/console.error() will add a newline, so we buffer until we
-      // receive one and then let it add it for us.
-      this.stderr = (function() {
-        var buffer = [];
-        return function(data) {
-          for (var i = 0; i < data.length; i++) {
-            var x = data.charAt(i);
-            if (x !== "\n") {
-              buffer.push(x);
-            } else {
-              _printErr(buffer.join(""));
-              buffer.splice(undefined, buffer.length);
-            }
-          }
-        }
-      })();
+    if (obj.stderr === null) {
+      obj.stderr = lineBuffered(_printErr);
+    }
+  }
+  if (obj.stdout === null) {
+    obj.stdout = devNull.stdout;
+  }
+  if (obj.stderr === null) {
+    obj.stderr = devNull.stderr;
+  }
+}
+
+
+// A buffered output stream for the VM.
+//
+// This collects the bytes written by the VM and passes them on as whole
+// chunks of text, decoded from utf-8.  It's flushed at each newline, when
+// the buffer fills up, and at the end of each call into the VM.  Output to
+// the "other" stream is flushed first, so that stdout and stderr keep their
+// relative order.
+
+var OUTPUT_BUFFER_SIZE = 8192;
+
+function OutputStream(write) {
+  this.other = null;
+  this._write = write;
+  this._buffer = new Uint8Array(OUTPUT_BUFFER_SIZE);
+  this._length = 0;
+  this._decoder = null;
+  if (typeof TextDecoder !== "undefined") {
+    this._decoder = new TextDecoder("utf-8");
+  }
+}
+
+OutputStream.prototype.putByte = function putByte(x) {
+  x = x & 0xFF;
+  if (this._length === 0 && this.other && this.other._length) {
+    this.other.flush();
+  }
+  this._buffer[this._length++] = x;
+  if (x === 10 || this._length === this._buffer.length) {
+    this.flush();
+  }
+}
+
+OutputStream.prototype.flush = function flush() {
+  if (!this._length) {
+    return;
+  }
+  var bytes = this._buffer.subarray(0, this._length);
+  var text;
+  if (this._decoder) {
+    // The decoder keeps any incomplete character for next time.
+    text = this._decoder.decode(bytes, { stream: true });
+    this._length = 0;
+  } else {
+    // Keep any incomplete character at the end for next time.
+    var end = _utf8CompleteLength(bytes);
+    text = _utf8Decode(bytes.subarray(0, end));
+    this._buffer.set(bytes.subarray(end));
+    this._length -= end;
+  }
+  if (text) {
+    this._write(text);
+  }
+}
+
+
+// Decode utf-8 by hand, for environments without a TextDecoder.
+// Invalid bytes are decoded as the unicode replacement character.
+
+function _utf8Decode(bytes) {
+  var chars = [];
+  var i = 0;
+  while (i < bytes.length) {
+    var b = bytes[i++];
+    var extra = 0;
+    var c = b;
+    if (b >= 0xF8 || (b >= 0x80 && b < 0xC0)) {
+      chars.push(0xFFFD);
+      continue;
+    } else if (b >= 0xF0) {
+      extra = 3;
+      c = b & 0x07;
+    } else if (b >= 0xE0) {
+      extra = 2;
+      c = b & 0x0F;
+    } else if (b >= 0xC0) {
+      extra = 1;
+      c = b & 0x1F;
+    }
+    for (var j = 0; j < extra; j++) {
+      if (i >= bytes.length || (bytes[i] & 0xC0) !== 0x80) {
+        c = 0xFFFD;
+        break;
+      }
+      c = (c << 6) | (bytes[i++] & 0x3F);
+    }
+    if (c >= 0x10000) {
+      c -= 0x10000;
+      chars.push(0xD800 + (c >> 10), 0xDC00 + (c & 0x3FF));
+    } else {
+      chars.push(c);
     }
   }
-  if (this.stdout === null) {
-    this.stdout = devNull.stdout;
+  var parts = [];
+  for (var k = 0; k < chars.length; k += 4096) {
+    parts.push(String.fromCharCode.apply(null, chars.slice(k, k + 4096)));
+  }
+  return parts.join("");
+}
+
+// Find the number of bytes in the utf-8 encoding of a string.
+function _utf8Length(str) {
+  var n = 0;
+  for (var i = 0; i < str.length; i++) {
+    var c = str.charCodeAt(i);
+    if (c < 0x80) {
+      n += 1;
+    } else if (c < 0x800) {
+      n += 2;
+    } else if (c >= 0xD800 && c < 0xDC00 && i + 1 < str.length &&
+               (str.charCodeAt(i + 1) & 0xFC00) === 0xDC00) {
+      // A surrogate pair, for a single four-byte character.
+      n += 4;
+      i++;
+    } else {
+      n += 3;
+    }
   }
-  if (this.stderr === null) {
-    this.stderr = devNull.stderr;
+  return n;
+}
+
+// Find the length of the bytes up to any incomplete character at the end.
+function _utf8CompleteLength(bytes) {
+  var n = bytes.length;
+  for (var i = 1; i <= 3 && i <= n; i++) {
+    var b = bytes[n - i];
+    if ((b & 0xC0) !== 0x80) {
+      var needed = b >= 0xF0 ? 4 : b >= 0xE0 ? 3 : b >= 0xC0 ? 2 : 1;
+      return needed > i ? n - i : n;
+    }
   }
+  return n;
+}
+
+
+// Main class representing the PyPy VM.
+// This is our primary export and return value.
+function PyPyJS(opts) {
+
+  setDefaultIO(this);
 
   opts = opts || {};
   this.rootURL = opts.rootURL;
   this.totalMemory = opts.totalMemory || 128 * 1024 * 1024;
+
+  // A VM may be started from a snapshot of another VM, rather than
+  // having to go through the full startup process itself.
+  this._snapshot = opts.snapshot || null;
+  // This is set before the constructor runs by _newSnapshotVM().
+  this._takeSnapshot = this._takeSnapshot || false;
+  this._bundleID = null;
+  this._mountModules = opts.mountModules || false;
+  if (this._snapshot) {
+    this.rootURL = this.rootURL || this._snapshot.rootURL;
+    this.totalMemory = this._snapshot.totalMemory;
+    this._mountModules = this._snapshot.mountModules || false;
+  }
+  // The heap may be allowed to grow on demand, if the compiled VM
+  // supports it.  By default it stays at its initial size.
+  this.maximumMemory = Math.max(opts.maximumMemory || 0, this.totalMemory);
+  this.memoryGrowthPolicy = opts.memoryGrowthPolicy || null;
+  this._memoryGrowths = 0;
+  this._peakMemory = 0;
   this.autoLoadModules = opts.autoLoadModules || true;
+  // With the modules mounted from disk, there's nothing to load.
+  if (this._mountModules) {
+    this.autoLoadModules = false;
+  }
+  this.maxConcurrentFetches = opts.maxConcurrentFetches || 6;
+  this.cache = opts.cache || null;
   this._pendingModules = {};
   this._loadedModules = {};
   this._allModules = {};
+  this._allPacks = {};
+  this._allShards = {};
+  this._pendingShards = {};
+  this._moduleNames = null;
+  this._fileNames = {};
+  this._fetchQueue = [];
+  this._fetchesInFlight = 0;
+
+  // Python code reports results and errors back to us via this object,
+  // and we keep the code that we've compiled for re-use.
+  this._rpc = {};
+  this._compiledCode = {};
+  this._compiledCodeCount = 0;
+  this._nextCodeID = 0;
+
+  // Optionally record the order in which modules are loaded, so that
+  // the bundler can choose which modules to preload.
+  this._moduleTrace = opts.recordModuleTrace ? [] : null;
+  this._moduleTraceSeen = {};
 
   // Allow opts to override default IO streams.
   this.stdin = opts.stdin || this.stdin;
@@ -221,20 +387,97 @@ function PyPyJS(opts) {
     this.rootURL += "/";
   } 
 
+  // Begin fetching the metadata for available python modules.
+  // With luck these can download while we jank around compiling
+  // all of that javascript.  We need it before linking the VM, since
+  // it may tell us the content-addressed name of the memory initializer.
+  // When starting from a snapshot, we already have all that we need.
+  var modIndexP;
+  if (this._snapshot) {
+    modIndexP = Promise.resolve({ files: this._snapshot.fileNames });
+  } else {
+    modIndexP = this.fetch("modules/index.json").then((function(xhr) {
+      if (this._takeSnapshot) {
+        this._bundleID = _bundleID(xhr.responseText);
+      }
+      return JSON.parse(xhr.responseText);
+    }).bind(this));
+  }
+  modIndexP = modIndexP.then((function(modIndex) {
+    this._fileNames = modIndex.files || {};
+    return modIndex;
+  }).bind(this));
+  var moduleDataP = modIndexP.then((function(modIndex) {
+    if (this._snapshot) {
+      this._snapshot._restoreModuleData(this);
+      return modIndex;
+    }
+    if (this._mountModules) {
+      // Every module is already available, including the preloaded ones.
+      return {};
+    }
+    if (!modIndex.names) {
+      this._allModules = modIndex.modules;
+      this._allPacks = modIndex.packs || {};
+      return modIndex;
+    }
+    // This is a split index, so module names are given by their
+    // position in the list of names, and the rest of the module
+    // metadata and preloaded files must be fetched separately.
+    this._moduleNames = modIndex.names;
+    this._allShards = modIndex.shards || {};
+    this._addIndexModules(modIndex.modules);
+    var packs = modIndex.packs || {};
+    for (var packName in packs) {
+      packs[packName].modules = this._getModuleNames(packs[packName].modules);
+    }
+    this._allPacks = packs;
+    var preloadPack = modIndex.preload_pack;
+    return this.fetch("modules/" + (preloadPack.url || preloadPack.file))
+    .then(function(xhr) {
+      var contents = JSON.parse(xhr.responseText);
+      modIndex.preload = contents.modules;
+      modIndex.preload_bytecode = contents.bytecode;
+      return modIndex;
+    });
+  }).bind(this));
+
   // If we haven't already done so, fetch and load the code for the VM.
   // We do this once and cache the result for re-use, so that we don't
   // have to pay asmjs compilation overhead each time we create the VM.
+  // If we have a persistent cache, we wait to see if the module metadata
+  // gives a content-addressed name for the code, which is safe to cache.
 
   if (! PyPyJS._vmBuilderPromise) {
-    PyPyJS._vmBuilderPromise = this.fetch("pypy.vm.js").then((function(xhr) {
+    var vmFileP = Promise.resolve("pypy.vm.js");
+    if (this._snapshot) {
+      vmFileP = Promise.resolve(this._snapshot.vmFile);
+    } else if (this.cache) {
+      vmFileP = modIndexP.then((function() {
+        return this._locateFile("pypy.vm.js");
+      }).bind(this), function() {
+        return "pypy.vm.js";
+      });
+    }
+    var vmFile;
+    PyPyJS._vmBuilderPromise = vmFileP.then((function(file) {
+      vmFile = file;
+      // Where the code can be compiled from a Blob, we fetch it as binary
+      // data and pass it along as-is, rather than decoding it into one
+      // giant string and then making a copy with our extra code on the end.
+      return this.fetch(vmFile, typeof Blob !== "undefined" ? "arraybuffer" : "");
+    }).bind(this)).then((function(xhr) {
       // Parse the compiled code, hopefully asynchronously.
       // Unfortunately our use of Function constructor here doesn't
       // play very well with nodejs, where things like 'module' and
       // 'require' are not in the global scope.  We have to pass them
       // in explicitly as arguments.
-      var funcBody = [
-        // This is the compiled code for the VM.
-        xhr.responseText,
+      var vmCode = xhr.response;
+      if (typeof vmCode === "undefined" || vmCode === null) {
+        vmCode = xhr.responseText;
+      }
+      // This is our extra code to go after the compiled code for the VM.
+      var glue = [
         '\n',
         // Ensure that some functions are available on the Module,
         // for linking with jitted code.
@@ -245,15 +488,77 @@ function PyPyJS(opts) {
         // which appear in this scope when evaluating the above.
         "Module._emjs_make_handle = _emjs_make_handle;",
         "Module._emjs_free = _emjs_free;",
+        // Allow the modules directory to be mounted from disk in nodejs.
+        "if (typeof NODEFS !== 'undefined') {",
+        "  Module.NODEFS = NODEFS;",
+        "}",
+        // Allow the top of the heap to be saved and restored in snapshots.
+        "if (typeof DYNAMICTOP !== 'undefined') {",
+        "  Module._getDynamicTop = function() { return DYNAMICTOP; };",
+        "  Module._setDynamicTop = function(top) { DYNAMICTOP = top; };",
+        "}",
+        // Let us decide whether the heap may grow, if it was compiled to
+        // allow it, and keep the Module's view of the heap up to date.
+        "if (typeof enlargeMemory === 'function' &&",
+        "    typeof _emscripten_replace_memory !== 'undefined') {",
+        "  Module._canGrowMemory = true;",
+        "  var _pypyjs_enlargeMemory = enlargeMemory;",
+        "  enlargeMemory = function() {",
+        "    var oldSize = HEAPU8.length;",
+        "    var required = Module._getDynamicTop ? Module._getDynamicTop() : null;",
+        "    if (!Module.shouldGrowMemory(oldSize, required)) return false;",
+        "    if (!_pypyjs_enlargeMemory()) return false;",
+        "    Module.HEAPU8 = HEAPU8;",
+        "    Module.onMemoryGrowth(oldSize, HEAPU8.length);",
+        "    return true;",
+        "  };",
+        "}",
+        // If we fetched the memory initializer ourselves then the compiled
+        // code won't have loaded it, and we must copy it into place.
+        "if (!memoryInitializer && Module.memoryInitializerData) {",
+        "  HEAPU8.set(new Uint8Array(Module.memoryInitializerData), STATIC_BASE);",
+        "  Module.memoryInitializerData = null;",
+        "}",
         // Call dependenciesFulfilled if it won't be done automatically.
         "dependenciesFulfilled=function() { inDependenciesFulfilled(FS); };",
         "if(!memoryInitializer||(!ENVIRONMENT_IS_WEB&&!ENVIRONMENT_IS_WORKER))dependenciesFulfilled();",
       ].join("");
-      return FunctionPromise("Module", "inDependenciesFulfilled", "require",
-                             "module", "__filename", "__dirname", funcBody)
+      var funcBody = [vmCode, glue];
+      // In nodejs, keep V8's code cache for the VM next to its code,
+      // so that later processes can skip most of the work of compiling it.
+      var funcOpts = {};
+      if (typeof fs !== "undefined" && typeof path !== "undefined") {
+        var rootURL = this.rootURL || PyPyJS.rootURL;
+        funcOpts.filename = path.join(rootURL, vmFile);
+        funcOpts.cacheFile = funcOpts.filename + ".v8cache";
+      }
+      return FunctionPromise.withOptions(funcOpts, "Module",
+                                         "inDependenciesFulfilled", "require",
+                                         "module", "__filename", "__dirname",
+                                         funcBody)
     }).bind(this));
   }
 
+  // Likewise fetch the memory initializer, so that it can download while
+  // the code is being compiled rather than after.  If it can't be found,
+  // we leave the compiled code to try loading it in the usual way.
+  // A VM started from a snapshot doesn't need it at all, but we must give
+  // it some data so that the compiled code doesn't go looking for it.
+
+  var memoryInitializerP = PyPyJS._memoryInitializerPromise;
+  if (this._snapshot) {
+    memoryInitializerP = Promise.resolve(new ArrayBuffer(0));
+  } else if (! memoryInitializerP) {
+    PyPyJS._memoryInitializerPromise = modIndexP.then((function() {
+      return this.fetch(this._locateFile("pypy.vm.js.mem"), "arraybuffer");
+    }).bind(this)).then(function(xhr) {
+      return xhr.response;
+    }, function(err) {
+      return null;
+    });
+    memoryInitializerP = PyPyJS._memoryInitializerPromise;
+  }
+
   // Create a new instance of the compiled VM, bound to local state
   // and a local Module object.
 
@@ -265,15 +570,20 @@ function PyPyJS(opts) {
     var Module = {};
     this._module = Module;
     Module.TOTAL_MEMORY = this.totalMemory;
+    Module.shouldGrowMemory = this._shouldGrowMemory.bind(this);
+    Module.onMemoryGrowth = (function(oldSize, newSize) {
+      this._memoryGrowths++;
+      this._updatePeakMemory();
+    }).bind(this);
 
     // We will set up the filesystem manually when we're ready.
     Module.noFSInit = true;
     Module.thisProgram = "/lib/pypyjs/pypy.js";
     Module.filePackagePrefixURL = this.rootURL || PyPyJS.rootURL;
     Module.memoryInitializerPrefixURL = this.rootURL || PyPyJS.rootURL;
-    Module.locateFile = function(name) {
-      return (this.rootURL || PyPyJS.rootURL) + name;
-    }
+    Module.locateFile = (function(name) {
+      return (this.rootURL || PyPyJS.rootURL) + this._locateFile(name);
+    }).bind(this);
 
     // Don't start or stop the program, just set it up.
     // We'll call the API functions ourself.
@@ -281,28 +591,24 @@ function PyPyJS(opts) {
     Module.noExitRuntime = true;
 
     // Route stdin to an overridable method on the object.
+    // Any prompt that was written out should be shown before reading.
     var stdin = (function stdin() {
+      this._flushOutput();
       return this.stdin();
     }).bind(this);
- 
-    // Route stdout to an overridable method on the object.
-    // We buffer the output for efficiency.
-    var stdout_buffer = []
-    var stdout = (function stdout(x) {
-      var c = String.fromCharCode(x);
-      stdout_buffer.push(c);
-      if (c === "\n" || stdout_buffer.length >= 128) {
-        this.stdout(stdout_buffer.join(""));
-        stdout_buffer = [];
-      }
-    }).bind(this);
 
-    // Route stderr to an overridable method on the object.
-    // We do not buffer stderr.
-    var stderr = (function stderr(x) {
-      var c = String.fromCharCode(x);
-      this.stderr(c);
-    }).bind(this);
+    // Route stdout and stderr to overridable methods on the object.
+    // We buffer the output for efficiency, and decode it from utf-8.
+    this._stdoutStream = new OutputStream((function(data) {
+      this.stdout(data);
+    }).bind(this));
+    this._stderrStream = new OutputStream((function(data) {
+      this.stderr(data);
+    }).bind(this));
+    this._stdoutStream.other = this._stderrStream;
+    this._stderrStream.other = this._stdoutStream;
+    var stdout = this._stdoutStream.putByte.bind(this._stdoutStream);
+    var stderr = this._stderrStream.putByte.bind(this._stderrStream);
 
     // This is where execution will continue after loading
     // the memory initialization data, if any.
@@ -312,26 +618,30 @@ function PyPyJS(opts) {
       initializedReject = reject;
     });
     var FS;
-    dependenciesFulfilled = function(fs) {
+    var dependenciesFulfilled = (function(fs) {
       FS = fs;
+      this._FS = FS;
       // Initialize the filesystem state.
       try {
         FS.init(stdin, stdout, stderr);
         Module.FS_createPath("/", "lib/pypyjs/lib_pypy", true, false);
         Module.FS_createPath("/", "lib/pypyjs/lib-python/2.7", true, false);
+        if (this._mountModules) {
+          this._mountModuleDir();
+        }
         initializedResolve();
       } catch (err) {
         initializedReject(err);
       }
-    }
+    }).bind(this);
  
-    // Begin fetching the metadata for available python modules.
-    // With luck these can download while we jank around compiling
-    // all of that javascript.
-    // XXX TODO: also load memory initializer this way.
-    var moduleDataP = this.fetch("modules/index.json");
-
-    PyPyJS._vmBuilderPromise.then((function(vmBuilder) {
+    Promise.all([
+      PyPyJS._vmBuilderPromise,
+      moduleDataP,
+      memoryInitializerP
+    ]).then((function(res) {
+      var vmBuilder = res[0];
+      Module.memoryInitializerData = res[2];
       var args = [
         Module,
         dependenciesFulfilled,
@@ -345,28 +655,171 @@ function PyPyJS(opts) {
       return initializedP;
     }).bind(this)).then((function() {
       // Continue with processing the downloaded module metadata.
-      return moduleDataP.then((function(xhr) {
-        // Store the module index, and load any preload modules.
-        var modIndex = JSON.parse(xhr.responseText);
-        this._allModules = modIndex.modules;
-        if (modIndex.preload) {
-          for (var name in modIndex.preload) {
-            this._writeModuleFile(name, modIndex.preload[name]);
+      return moduleDataP.then((function(modIndex) {
+        if (this._snapshot) {
+          // Initialize the runtime, then overwrite its state with
+          // that of the fully-started VM from the snapshot.
+          Module.run();
+          this._snapshot._restore(this);
+        } else {
+          // Load any preload modules from the index.
+          if (modIndex.preload) {
+            for (var name in modIndex.preload) {
+              this._writeModuleFile(name, modIndex.preload[name]);
+            }
+          }
+          if (modIndex.preload_bytecode) {
+            for (var name in modIndex.preload_bytecode) {
+              var bytecode = _base64Decode(modIndex.preload_bytecode[name]);
+              this._writeModuleBytecode(name, bytecode);
+            }
+          }
+          // It's finally safe to launch the VM.
+          Module.run();
+          Module._rpython_startup_code();
+          var pypy_home = Module.intArrayFromString("/lib/pypyjs/pypy.js");
+          pypy_home = Module.allocate(pypy_home, 'i8', Module.ALLOC_NORMAL);
+          Module._pypy_setup_home(pypy_home, 0);
+          Module._free(pypy_home);
+          // Snapshots are taken before any code has touched the "js"
+          // module, since handles to javascript objects live outside
+          // the heap and can't be copied into another VM.
+          if (this._takeSnapshot) {
+            this._takenSnapshot = new PyPyJS.Snapshot(this);
           }
         }
-        // It's finally safe to launch the VM.
-        Module.run();
-        Module._rpython_startup_code();
-        var pypy_home = Module.intArrayFromString("/lib/pypyjs/pypy.js");
-        pypy_home = Module.allocate(pypy_home, 'i8', Module.ALLOC_NORMAL);
-        Module._pypy_setup_home(pypy_home, 0);
-        Module._free(pypy_home);
         var initCode = [
           "import js",
           "import sys; sys.platform = 'js'",
           "import traceback",
           "top_level_scope = {'__name__': '__main__'}"
         ];
+        // Don't try to write bytecode files into mounted directories.
+        if (this._mountModules) {
+          initCode.push("sys.dont_write_bytecode = True");
+        }
+        // Install the helper that runs compiled code for _run_code().
+        var rpc = Module._emjs_make_handle(this._rpc);
+        initCode.push(
+          "class _PyPyJSExecutor(object):\n" +
+          "  def __init__(self, rpc):\n" +
+          "    self.rpc = rpc\n" +
+          "    self.code = {}\n" +
+          "  def compile(self, id, source, mode):\n" +
+          "    try:\n" +
+          "      self.code[id] = (compile(source, '<string>', " +
+                   "'exec' if mode == 'exec' else 'eval'), mode)\n" +
+          "    except Exception:\n" +
+          "      self.report()\n" +
+          "  def run(self, id):\n" +
+          "    try:\n" +
+          "      code, mode = self.code[id]\n" +
+          "      if mode == 'exec':\n" +
+          "        exec code in top_level_scope\n" +
+          "      elif mode == 'eval':\n" +
+          "        self.result(eval(code, top_level_scope))\n" +
+          "      else:\n" +
+          "        self.result(eval(code, globals()))\n" +
+          "    except Exception:\n" +
+          "      self.report()\n" +
+          // Containers are sent back as a single JSON string where possible,
+          // rather than being converted one value at a time.  The encoder is
+          // built in, so that it works without the json module.
+          "  def result(self, value):\n" +
+          "    if isinstance(value, (list, tuple, dict)):\n" +
+          "      parts = []\n" +
+          "      try:\n" +
+          "        self.to_json(value, parts)\n" +
+          "        self.rpc.resultJSON = u''.join(parts)\n" +
+          "        return\n" +
+          "      except (TypeError, ValueError, RuntimeError):\n" +
+          "        pass\n" +
+          "    self.rpc.result = js.convert(value)\n" +
+          "  json_escapes = dict([(i, u'\\\\u%04x' % i) for i in range(32)] +\n" +
+          "                      [(ord(u'\"'), u'\\\\\"'), (ord(u'\\\\'), u'\\\\\\\\')])\n" +
+          "  inf = float('inf')\n" +
+          "  def to_json(self, value, parts):\n" +
+          "    if value is None:\n" +
+          "      parts.append('null')\n" +
+          "    elif value is True:\n" +
+          "      parts.append('true')\n" +
+          "    elif value is False:\n" +
+          "      parts.append('false')\n" +
+          "    elif isinstance(value, (int, long)):\n" +
+          "      parts.append('%d' % (value,))\n" +
+          "    elif isinstance(value, float):\n" +
+          "      if value != value or value == self.inf or value == -self.inf:\n" +
+          "        raise ValueError('not representable in JSON')\n" +
+          "      parts.append(repr(float(value)))\n" +
+          "    elif isinstance(value, basestring):\n" +
+          "      if isinstance(value, str):\n" +
+          "        value = value.decode('utf-8')\n" +
+          "      parts.append(u'\"' + value.translate(self.json_escapes) + u'\"')\n" +
+          "    elif isinstance(value, (list, tuple)):\n" +
+          "      parts.append('[')\n" +
+          "      for i, item in enumerate(value):\n" +
+          "        if i:\n" +
+          "          parts.append(',')\n" +
+          "        self.to_json(item, parts)\n" +
+          "      parts.append(']')\n" +
+          "    elif isinstance(value, dict):\n" +
+          "      parts.append('{')\n" +
+          "      for i, (key, item) in enumerate(value.iteritems()):\n" +
+          "        if not isinstance(key, basestring):\n" +
+          "          raise TypeError('not representable in JSON')\n" +
+          "        if i:\n" +
+          "          parts.append(',')\n" +
+          "        self.to_json(key, parts)\n" +
+          "        parts.append(':')\n" +
+          "        self.to_json(item, parts)\n" +
+          "      parts.append('}')\n" +
+          "    else:\n" +
+          "      raise TypeError('not representable in JSON')\n" +
+          "  def get_many(self, namespace, names):\n" +
+          "    return dict((n, namespace[n]) for n in names if n in namespace)\n" +
+          "  def report(self):\n" +
+          "    typ, val, tb = sys.exc_info()\n" +
+          "    self.rpc.errorName = getattr(typ, '__name__', str(typ))\n" +
+          "    self.rpc.errorMessage = str(val)\n" +
+          "    trace = traceback.format_exception(typ, val, tb)\n" +
+          "    self.rpc.errorTrace = ''.join(trace)\n" +
+          // These take their arguments from the rpc object, so that the code
+          // to call them never changes, and report back on it directly.
+          "  def new_array(self):\n" +
+          "    import array\n" +
+          "    name = str(self.rpc.arrayName)\n" +
+          "    typecode = str(self.rpc.arrayTypecode)\n" +
+          "    length = int(str(self.rpc.arrayLength))\n" +
+          "    a = array.array(typecode, [0]) * length\n" +
+          "    top_level_scope[name] = a\n" +
+          "    self.rpc.arrayAddress, self.rpc.arrayLength = a.buffer_info()\n" +
+          "  def array_info(self):\n" +
+          "    import array\n" +
+          "    name = str(self.rpc.arrayName)\n" +
+          "    a = top_level_scope[name]\n" +
+          "    if not isinstance(a, array.array):\n" +
+          "      raise TypeError('%s is not an array.array' % (name,))\n" +
+          "    self.rpc.arrayTypecode = a.typecode\n" +
+          "    self.rpc.arrayAddress, self.rpc.arrayLength = a.buffer_info()\n" +
+          "_pypyjs_executor = _PyPyJSExecutor(js.Value(" + rpc + "))"
+        );
+        // Install an import hook that loads module data on demand.
+        // It never finds modules itself, it just makes sure that the
+        // files are in place for the usual import machinery to find.
+        if (this.autoLoadModules) {
+          var loader = Module._emjs_make_handle(this._loadModuleDataSync.bind(this));
+          initCode.push(
+            "class _PyPyJSModuleFinder(object):\n" +
+            "  def __init__(self, load):\n" +
+            "    self.load = load\n" +
+            "  def find_module(self, fullname, path=None):\n" +
+            "    err = str(self.load(fullname))\n" +
+            "    if err:\n" +
+            "      raise ImportError(err)\n" +
+            "    return None\n" +
+            "sys.meta_path.insert(0, _PyPyJSModuleFinder(js.Value(" + loader + ")))"
+          );
+        }
         initCode.forEach(function(codeStr) {
           var code = Module.intArrayFromString(codeStr);
           var code = Module.allocate(code, 'i8', Module.ALLOC_NORMAL);
@@ -387,10 +840,58 @@ function PyPyJS(opts) {
 };
 
 
+// Fetch a file, using the persistent cache if there is one.
+//
+// Content-addressed files never change, so we use any cached copy of them
+// without going to the network at all.  Other files are always fetched
+// afresh, but their cached copies are used if they can't be fetched,
+// e.g. because we're offline.
+//
+PyPyJS.prototype.fetch = function fetch(relpath, responseType) {
+  var cache = this.cache;
+  if (!cache) {
+    return this._fetch(relpath, responseType);
+  }
+  var makeResponse = function(data) {
+    if (responseType === "arraybuffer") {
+      return { response: data };
+    }
+    return { responseText: data };
+  };
+  var fetchAndCache = (function() {
+    return this._fetch(relpath, responseType).then(function(xhr) {
+      var data = responseType === "arraybuffer" ? xhr.response : xhr.responseText;
+      cache.put(relpath, data).then(null, function(err) {
+        debug("Failed to cache " + relpath + ": " + err);
+      });
+      return xhr;
+    });
+  }).bind(this);
+  if (/(^|\/)hashed\//.test(relpath)) {
+    return cache.get(relpath, responseType).then(function(data) {
+      if (data === null || typeof data === "undefined") {
+        return fetchAndCache();
+      }
+      return makeResponse(data);
+    }, fetchAndCache);
+  }
+  return fetchAndCache().then(null, function(err) {
+    return cache.get(relpath, responseType).then(function(data) {
+      if (data === null || typeof data === "undefined") {
+        throw err;
+      }
+      return makeResponse(data);
+    }, function() {
+      throw err;
+    });
+  });
+}
+
+
 // A simple file-fetching wrapper around XMLHttpRequest,
 // that treats paths as relative to the pypy.js root url.
 //
-PyPyJS.prototype.fetch = function fetch(relpath, responseType) {
+PyPyJS.prototype._fetch = function _fetch(relpath, responseType) {
   // For the web, use XMLHttpRequest.
   if (typeof XMLHttpRequest !== "undefined") {
     return new Promise((function(resolve, reject) {
@@ -414,7 +915,11 @@ PyPyJS.prototype.fetch = function fetch(relpath, responseType) {
       var rootURL = this.rootURL || PyPyJS.rootURL;
       fs.readFile(path.join(rootURL, relpath), function(err, data) {
         if (err) return reject(err);
-        resolve({ responseText: data.toString() });
+        if (responseType === "arraybuffer") {
+          resolve({ response: new Uint8Array(data).buffer });
+        } else {
+          resolve({ responseText: data.toString() });
+        }
       });
     }).bind(this));
   }
@@ -422,16 +927,26 @@ PyPyJS.prototype.fetch = function fetch(relpath, responseType) {
   if (typeof snarf !== "undefined") {
     return new Promise((function(resolve, reject) {
       var rootURL = this.rootURL || PyPyJS.rootURL;
-      var data = snarf(rootURL + relpath);
-      resolve({ responseText: data });
+      if (responseType === "arraybuffer") {
+        var data = snarf(rootURL + relpath, "binary");
+        resolve({ response: data.buffer });
+      } else {
+        var data = snarf(rootURL + relpath);
+        resolve({ responseText: data });
+      }
     }).bind(this));
   }
   // For d8, use read() and readbuffer().
   if (typeof read !== "undefined" && typeof readbuffer !== "undefined") {
     return new Promise((function(resolve, reject) {
       var rootURL = this.rootURL || PyPyJS.rootURL;
-      var data = read(rootURL + relpath);
-      resolve({ responseText: data });
+      if (responseType === "arraybuffer") {
+        var data = readbuffer(rootURL + relpath);
+        resolve({ response: data });
+      } else {
+        var data = read(rootURL + relpath);
+        resolve({ responseText: data });
+      }
     }).bind(this));
   }
   return new Promise(function(resolve, reject) {
@@ -440,6 +955,101 @@ PyPyJS.prototype.fetch = function fetch(relpath, responseType) {
 };
 
 
+// A synchronous version of fetch, for the import hook.
+// This can only use a persistent cache that has a "getSync" method,
+// so in the browser it always goes to the network.  Errors are thrown
+// as ImportErrors saying which file couldn't be fetched.
+//
+PyPyJS.prototype._fetchSync = function _fetchSync(relpath, responseType) {
+  var cache = this.cache;
+  var getCached = function() {
+    if (!cache || typeof cache.getSync !== "function") {
+      return null;
+    }
+    var data = cache.getSync(relpath, responseType);
+    if (data === null || typeof data === "undefined") {
+      return null;
+    }
+    if (responseType === "arraybuffer") {
+      return { response: data };
+    }
+    return { responseText: data };
+  };
+  if (/(^|\/)hashed\//.test(relpath)) {
+    var cached = getCached();
+    if (cached) {
+      return cached;
+    }
+  }
+  try {
+    var xhr = this._fetchUncachedSync(relpath, responseType);
+  } catch (err) {
+    var cached = getCached();
+    if (cached) {
+      return cached;
+    }
+    throw new PyPyJS.Error("ImportError", "failed to fetch " + relpath + ": " +
+                           (err && err.message || String(err)));
+  }
+  if (cache) {
+    var data = responseType === "arraybuffer" ? xhr.response : xhr.responseText;
+    cache.put(relpath, data).then(null, function(err) {
+      debug("Failed to cache " + relpath + ": " + err);
+    });
+  }
+  return xhr;
+}
+
+PyPyJS.prototype._fetchUncachedSync = function _fetchUncachedSync(relpath, responseType) {
+  var rootURL = this.rootURL || PyPyJS.rootURL;
+  // For the web, use a synchronous XMLHttpRequest.  These can't ask for
+  // binary data, so we have it sent as one character per byte instead.
+  if (typeof XMLHttpRequest !== "undefined") {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', rootURL + relpath, false);
+    if (responseType === "arraybuffer") {
+      xhr.overrideMimeType("text/plain; charset=x-user-defined");
+    }
+    xhr.send(null);
+    if (xhr.status >= 400) {
+      throw new PyPyJS.Error("HTTP status " + xhr.status);
+    }
+    if (responseType === "arraybuffer") {
+      var text = xhr.responseText;
+      var data = new Uint8Array(text.length);
+      for (var i = 0; i < text.length; i++) {
+        data[i] = text.charCodeAt(i) & 0xFF;
+      }
+      return { response: data.buffer };
+    }
+    return { responseText: xhr.responseText };
+  }
+  // For nodejs, use fs.readFileSync.
+  if (typeof fs !== "undefined" && typeof fs.readFileSync !== "undefined") {
+    var data = fs.readFileSync(path.join(rootURL, relpath));
+    if (responseType === "arraybuffer") {
+      return { response: new Uint8Array(data).buffer };
+    }
+    return { responseText: data.toString() };
+  }
+  // For spidermonkey, use snarf (which has a binary read mode).
+  if (typeof snarf !== "undefined") {
+    if (responseType === "arraybuffer") {
+      return { response: snarf(rootURL + relpath, "binary").buffer };
+    }
+    return { responseText: snarf(rootURL + relpath) };
+  }
+  // For d8, use read() and readbuffer().
+  if (typeof read !== "undefined" && typeof readbuffer !== "undefined") {
+    if (responseType === "arraybuffer") {
+      return { response: readbuffer(rootURL + relpath) };
+    }
+    return { responseText: read(rootURL + relpath) };
+  }
+  throw new PyPyJS.Error("unable to fetch files");
+}
+
+
 // Method to execute python source directly in the VM.
 //
 // This is the basic way to push code into the PyPyJS VM.
@@ -451,37 +1061,167 @@ PyPyJS.prototype._execute_source = function _execute_source(code) {
   code = "try:\n" +
          "  " + code + "\n" +
          "except Exception:\n" +
-         "  typ, val, tb = sys.exc_info()\n" +
-         "  err_name = getattr(typ, '__name__', str(typ))\n" +
-         "  err_msg = str(val)\n" +
-         "  err_trace = traceback.format_exception(typ, val, tb)\n" +
-         "  err_trace = ''.join(err_trace)\n" +
-         "  js.globals['PyPyJS']._lastErrorName = err_name\n" +
-         "  js.globals['PyPyJS']._lastErrorMessage = err_msg\n" +
-         "  js.globals['PyPyJS']._lastErrorTrace = err_trace\n";
-  var code_chars = Module.intArrayFromString(code);
-  var code_ptr = Module.allocate(code_chars, 'i8', Module.ALLOC_NORMAL);
+         "  _pypyjs_executor.report()\n";
+  var code_ptr = this._allocateString(code);
   if (!code_ptr) {
     return Promise.reject(new PyPyJS.Error("Failed to allocate memory"));
   }
-  var res = Module._pypy_execute_source(code_ptr);
+  var err = this._execute_ptr(code_ptr);
   Module._free(code_ptr);
-  // XXX TODO: races/re-entrancy on _lastError?
-  if (PyPyJS._lastErrorName) {
-    var err = new PyPyJS.Error(
-      PyPyJS._lastErrorName,
-      PyPyJS._lastErrorMessage,
-      PyPyJS._lastErrorTrace
-    );
-    PyPyJS._lastErrorName = null;
-    PyPyJS._lastErrorMessage = null;
-    PyPyJS._lastErrorTrace = null;
+  return err ? Promise.reject(err) : Promise.resolve(null);
+}
+
+
+PyPyJS.prototype._flushOutput = function _flushOutput() {
+  this._stdoutStream.flush();
+  this._stderrStream.flush();
+}
+
+
+// Method to execute python code via a cache of compiled code objects.
+//
+// This is a faster primitive than _execute_source for code that is run
+// repeatedly.  The code is compiled once, then each later call with the
+// same code just runs a short pre-allocated statement that looks it up.
+// The mode is "exec" or "eval" to run it in the top-level scope, or "get"
+// to evaluate it in the global scope.  Returns a promise for the result
+// of evaluating the code, if any.
+//
+var MAX_COMPILED_CODE = 1000;
+
+PyPyJS.prototype._run_code = function _run_code(code, mode) {
+  var key = mode + ":" + code;
+  var code_ptr = this._compiledCode[key];
+  if (!code_ptr) {
+    if (this._compiledCodeCount >= MAX_COMPILED_CODE) {
+      this._clearCompiledCode();
+    }
+    var id = this._nextCodeID++;
+    var err = this._execute_ptr(this._allocateString(
+      "_pypyjs_executor.compile(" + id + ", '''" + _escape(code) + "''', '" + mode + "')"
+    ), true);
+    if (err) {
+      return Promise.reject(err);
+    }
+    code_ptr = this._allocateString("_pypyjs_executor.run(" + id + ")");
+    if (!code_ptr) {
+      return Promise.reject(new PyPyJS.Error("Failed to allocate memory"));
+    }
+    this._compiledCode[key] = code_ptr;
+    this._compiledCodeCount++;
+  }
+  var err = this._execute_ptr(code_ptr);
+  var result = this._rpc.result;
+  var resultJSON = this._rpc.resultJSON;
+  this._rpc.result = undefined;
+  this._rpc.resultJSON = undefined;
+  if (err) {
     return Promise.reject(err);
   }
+  if (typeof resultJSON === "string") {
+    result = JSON.parse(resultJSON);
+  }
+  return Promise.resolve(result);
+}
+
+
+PyPyJS.prototype._clearCompiledCode = function _clearCompiledCode() {
+  var Module = this._module;
+  for (var key in this._compiledCode) {
+    Module._free(this._compiledCode[key]);
+  }
+  this._compiledCode = {};
+  this._compiledCodeCount = 0;
+  this._execute_ptr(this._allocateString("_pypyjs_executor.code.clear()"), true);
+}
+
+
+PyPyJS.prototype._allocateString = function _allocateString(str) {
+  var Module = this._module;
+  var chars = Module.intArrayFromString(str);
+  return Module.allocate(chars, 'i8', Module.ALLOC_NORMAL);
+}
+
+
+// Execute the python code at the given address in the heap, and return
+// any error that it reported, optionally freeing the code afterwards.
+//
+PyPyJS.prototype._execute_ptr = function _execute_ptr(code_ptr, free) {
+  var Module = this._module;
+  if (!code_ptr) {
+    return new PyPyJS.Error("Failed to allocate memory");
+  }
+  var res = Module._pypy_execute_source(code_ptr);
+  if (free) {
+    Module._free(code_ptr);
+  }
+  this._flushOutput();
+  this._updatePeakMemory();
+  var rpc = this._rpc;
+  if (rpc.errorName) {
+    var err = new PyPyJS.Error(rpc.errorName, rpc.errorMessage, rpc.errorTrace);
+    rpc.errorName = null;
+    rpc.errorMessage = null;
+    rpc.errorTrace = null;
+    return err;
+  }
   if (res < 0) {
-    return Promise.reject(new PyPyJS.Error("Error executing python code"));
+    return new PyPyJS.Error("Error executing python code");
+  }
+  return null;
+}
+
+
+// Decide whether the heap may grow beyond its current size, to make room
+// for at least the given number of bytes (if known).
+//
+// Code generated by the JIT is linked against the heap as it was when the
+// code was generated, and would go on using the old heap after it grew.
+// So the heap never grows in a VM that was built with the JIT.
+//
+PyPyJS.prototype._shouldGrowMemory = function _shouldGrowMemory(size, required) {
+  if (!this._canGrowMemory()) {
+    return false;
+  }
+  if (size >= this.maximumMemory) {
+    return false;
   }
-  return Promise.resolve(null);
+  if (required !== null && required > this.maximumMemory) {
+    return false;
+  }
+  if (this.memoryGrowthPolicy) {
+    return !!this.memoryGrowthPolicy(size, required, this.maximumMemory);
+  }
+  return true;
+}
+
+PyPyJS.prototype._canGrowMemory = function _canGrowMemory() {
+  var Module = this._module;
+  return !!Module._canGrowMemory && !Module._jitInvoke;
+}
+
+PyPyJS.prototype._updatePeakMemory = function _updatePeakMemory() {
+  var Module = this._module;
+  if (Module._getDynamicTop) {
+    this._peakMemory = Math.max(this._peakMemory, Module._getDynamicTop());
+  }
+}
+
+// Report on the interpreter's use of heap memory.  The amount in use is
+// the top of the heap, which doesn't go down when memory is freed.
+//
+PyPyJS.prototype.getMemoryStats = function getMemoryStats() {
+  var Module = this._module;
+  var used = Module._getDynamicTop ? Module._getDynamicTop() : null;
+  return {
+    heapSize: Module.HEAPU8 ? Module.HEAPU8.length : 0,
+    initialMemory: this.totalMemory,
+    maximumMemory: this.maximumMemory,
+    canGrow: this._canGrowMemory(),
+    growths: this._memoryGrowths,
+    used: used,
+    peakUsed: used === null ? null : Math.max(this._peakMemory, used)
+  };
 }
 
 
@@ -499,24 +1239,12 @@ function _escape(value) {
 //
 PyPyJS.prototype.exec = function exec(code) {
   return this.ready.then((function() {
-    var p = Promise.resolve();
-    // Find any "import" statements in the code,
-    // and ensure the modules are ready for loading.
-    if (this.autoLoadModules) {
-      p = p.then((function() {
-        return this.findImportedNames(code);
-      }).bind(this))
-      .then((function(imports) {
-        return this.loadModuleData.apply(this, imports);
-      }).bind(this))
-    }
-    // Now we can execute the code in custom top-level scope.
-    code = 'exec \'\'\'' + _escape(code) + '\'\'\' in top_level_scope';
-    p = p.then((function() {
-      return this._execute_source(code);
-    }).bind(this));
-    return p;
-  }).bind(this));
+    // Execute the code in custom top-level scope.
+    // Any modules that it imports are loaded by our import hook.
+    return this._run_code(code, "exec");
+  }).bind(this)).then(function() {
+    return null;
+  });
 }
 
 
@@ -532,13 +1260,9 @@ PyPyJS.prototype.exec = function exec(code) {
 PyPyJS.prototype.eval = function eval(expr) {
   return this.ready.then((function() {
     // First try to execute it as an expression.
-    code = "r = eval('" + _escape(expr) + "', top_level_scope)";
-    return this._execute_source(code);
+    return this._run_code(expr, "eval");
   }).bind(this)).then(
-    (function() {
-      // If that succeeded, return the result.
-      return this.get("r", true)
-    }).bind(this),
+    null,
     (function(err) {
       if (err && err.name && err.name !== "SyntaxError") {
         throw err;
@@ -571,10 +1295,7 @@ PyPyJS.prototype.execfile = function execfile(filename) {
 // equivalent javascript value and returns it.  It will fail if the variable
 // does not exist or contains a value that cannot be converted.
 //
-PyPyJS._resultsID = 0;
-PyPyJS._resultsMap = {};
 PyPyJS.prototype.get = function get(name, _fromGlobals) {
-  var resid = ""+(PyPyJS._resultsID++);
   // We can read from global scope for internal use; don't do this from calling code!
   if (_fromGlobals) {
     var namespace = "globals()";
@@ -583,13 +1304,33 @@ PyPyJS.prototype.get = function get(name, _fromGlobals) {
   }
   return this.ready.then((function() {
     var code = namespace + ".get('" + _escape(name) + "', js.undefined)";
-    code = "js.convert(" + code + ")"
-    code = "js.globals['PyPyJS']._resultsMap['" + resid + "'] = " + code;
-    return this._execute_source(code);
-  }).bind(this)).then((function() {
-    var res = PyPyJS._resultsMap[resid];
-    delete PyPyJS._resultsMap[resid];
-    return res;
+    return this._run_code(code, "get");
+  }).bind(this));
+}
+
+
+// Method to read several python variables at once.
+//
+// This returns an object mapping each of the given names to the value of
+// that python variable, converted as for get().  Names that don't exist
+// are left out of the result.
+//
+PyPyJS.prototype.getMany = function getMany(names) {
+  if (!Array.isArray(names)) {
+    return Promise.reject(new PyPyJS.Error("TypeError", "names must be an array"));
+  }
+  for (var i = 0; i < names.length; i++) {
+    if (typeof names[i] !== "string") {
+      return Promise.reject(new PyPyJS.Error("TypeError", "names must be strings"));
+    }
+  }
+  return this.ready.then((function() {
+    var quoted = [];
+    for (var i = 0; i < names.length; i++) {
+      quoted.push("'" + _escape(names[i]) + "'");
+    }
+    var code = "_pypyjs_executor.get_many(top_level_scope, [" + quoted.join(", ") + "])";
+    return this._run_code(code, "get");
   }).bind(this));
 }
 
@@ -610,6 +1351,94 @@ PyPyJS.prototype.set = function set(name, value) {
 }
 
 
+// Methods to exchange arrays of numbers with python code.
+//
+// These avoid converting each element of the array to or from a python
+// object.  setBuffer() copies a typed array into a new python array.array
+// object in a single block copy.  getBuffer() returns a typed array that
+// views the memory of a python array.array object directly, without any
+// copying at all.  The view is only valid until the python array is resized
+// or deleted, so pass {copy: true} to get a copy of its contents instead.
+//
+var ARRAY_TYPECODES = {
+  b: Int8Array,
+  B: Uint8Array,
+  c: Uint8Array,
+  h: Int16Array,
+  H: Uint16Array,
+  i: Int32Array,
+  I: Uint32Array,
+  l: Int32Array,
+  L: Uint32Array,
+  f: Float32Array,
+  d: Float64Array
+};
+
+PyPyJS.prototype.setBuffer = function setBuffer(name, array) {
+  var typecode = null;
+  for (var tc in ARRAY_TYPECODES) {
+    if (array instanceof ARRAY_TYPECODES[tc] && tc !== "c") {
+      typecode = tc;
+      break;
+    }
+  }
+  if (array instanceof Uint8ClampedArray) {
+    typecode = "B";
+  }
+  if (!typecode) {
+    return Promise.reject(new PyPyJS.Error("TypeError", "not a typed array"));
+  }
+  return this.ready.then((function() {
+    this._rpc.arrayName = String(name);
+    this._rpc.arrayTypecode = typecode;
+    this._rpc.arrayLength = array.length;
+    return this._run_array_code("_pypyjs_executor.new_array()");
+  }).bind(this)).then((function(info) {
+    if (array.length) {
+      var heap = this._module.HEAPU8.buffer;
+      new ARRAY_TYPECODES[typecode](heap, info.address, info.length).set(array);
+    }
+  }).bind(this));
+}
+
+// Run code that reports an array's details on the rpc object, and collect
+// them before any other code gets a chance to run.
+PyPyJS.prototype._run_array_code = function _run_array_code(code) {
+  var rpc = this._rpc;
+  var p = this._run_code(code, "get");
+  var info = {
+    typecode: rpc.arrayTypecode,
+    address: rpc.arrayAddress,
+    length: rpc.arrayLength
+  };
+  rpc.arrayName = rpc.arrayTypecode = undefined;
+  rpc.arrayAddress = rpc.arrayLength = undefined;
+  return p.then(function() {
+    return info;
+  });
+}
+
+PyPyJS.prototype.getBuffer = function getBuffer(name, opts) {
+  return this.ready.then((function() {
+    this._rpc.arrayName = String(name);
+    return this._run_array_code("_pypyjs_executor.array_info()");
+  }).bind(this)).then((function(info) {
+    var ArrayType = ARRAY_TYPECODES[info.typecode];
+    if (!ArrayType) {
+      throw new PyPyJS.Error("TypeError", "unsupported array typecode: " + info.typecode);
+    }
+    if (!info.length) {
+      return new ArrayType(0);
+    }
+    var view = new ArrayType(this._module.HEAPU8.buffer, info.address, info.length);
+    if (opts && opts.copy) {
+      return new ArrayType(view);
+    }
+    return view;
+  }).bind(this));
+}
+
+
 // Method to run an interactive REPL.
 //
 // This method takes takes callback function implementing the user
@@ -693,16 +1522,6 @@ PyPyJS.prototype._repl_loop = function _repl_loop(prmpt, ps1) {
     // Push it into the InteractiveConsole, a line at a time.
     var p = Promise.resolve();
     input.split("\n").forEach((function(line) {
-      // Find any "import" statements in the code,
-      // and ensure the modules are ready for loading.
-      if (this.autoLoadModules) {
-        p = p.then((function() {
-          return this.findImportedNames(line);
-        }).bind(this))
-        .then((function(imports) {
-          return this.loadModuleData.apply(this, imports);
-        }).bind(this))
-      }
       var code = 'r = c.push(\'' + _escape(line) + '\')';
       p = p.then((function() {
         return this._execute_source(code);
@@ -771,7 +1590,11 @@ PyPyJS.prototype.loadModuleData = function loadModuleData(/* names */) {
   // and load it along with all its dependencies.
   var modules = Array.prototype.slice.call(arguments);
   return this.ready.then((function() {
-    var toLoad = {};
+    // With a split index, we may first need to fetch the metadata
+    // for the packages containing the given names.
+    return this._loadIndexShards(modules);
+  }).bind(this)).then((function() {
+    var found = [];
     NEXTNAME: for (var i = 0; i < modules.length; i++) {
       var name = modules[i];
       // Find the nearest containing module for the given name.
@@ -783,24 +1606,227 @@ PyPyJS.prototype.loadModuleData = function loadModuleData(/* names */) {
         name = name.substr(0, name.lastIndexOf("."));
         if (!name) continue NEXTNAME;
       }
-      this._findModuleDeps(name, toLoad);
+      found.push(name);
     } 
+    return this._findAllModuleDeps(found);
+  }).bind(this)).then((function(toLoad) {
+    this._recordModuleTrace(toLoad);
     // Now ensure that each module gets loaded.
-    // XXX TODO: we could load these concurrently.
-    var p = Promise.resolve();
+    // Where a pack would provide only modules that we need, we fetch
+    // the whole pack in one go rather than loading its modules one by one.
+    // Bigger packs save more requests, so we try them first.
+    // The files are all fetched concurrently, up to a limit on the number
+    // of requests in flight, and written out as soon as they arrive.
+    var ps = [];
+    var packNames = Object.keys(this._allPacks).sort((function(a, b) {
+      return this._allPacks[b].modules.length -
+             this._allPacks[a].modules.length;
+    }).bind(this));
+    for (var j = 0; j < packNames.length; j++) {
+      var packName = packNames[j];
+      if (this._isPackNeeded(packName, toLoad)) {
+        ps.push(this._queueFetch(this._makeLoadPackData(packName)));
+        var packModules = this._allPacks[packName].modules;
+        for (var i = 0; i < packModules.length; i++) {
+          delete toLoad[packModules[i]];
+        }
+      }
+    }
     for (var name in toLoad) {
-      p = p.then(this._makeLoadModuleData(name));
+      ps.push(this._queueFetch(this._makeLoadModuleData(name)));
     }
-    return p;
+    return Promise.all(ps).then(function() {});
+  }).bind(this));
+}
+
+
+// Synchronously load the contents of a python module, along with any
+// dependencies.  This is called by our import hook whenever python code
+// imports a module that isn't already loaded, so it can't wait for the
+// files to arrive asynchronously.  Use loadModuleData() ahead of time to
+// fetch many modules concurrently instead.
+//
+// Returns an error message if the files couldn't be loaded, which the
+// import hook raises as an ImportError, or an empty string on success.
+//
+PyPyJS.prototype._loadModuleDataSync = function _loadModuleDataSync(name) {
+  name = String(name);
+  try {
+    this._loadIndexShardsSync([name]);
+    // Find the nearest containing module for the given name.
+    // If that's already loaded then there's nothing to do.
+    var modname = name;
+    while (!this._allModules[modname]) {
+      modname = modname.substr(0, modname.lastIndexOf("."));
+      if (!modname) return "";
+    }
+    // Trace the import even if the module was preloaded, so that
+    // traces cover everything the program actually uses.
+    var imported = {};
+    imported[modname] = true;
+    this._recordModuleTrace(imported);
+    if (this._loadedModules[modname]) {
+      return "";
+    }
+    var toLoad, shardNames;
+    do {
+      var shards = {};
+      toLoad = this._findModuleDeps(modname, {}, shards);
+      shardNames = Object.keys(shards);
+      this._loadIndexShardsSync(shardNames);
+    } while (shardNames.length);
+    this._recordModuleTrace(toLoad);
+    for (var packName in this._allPacks) {
+      if (this._isPackNeeded(packName, toLoad)) {
+        var packData = this._allPacks[packName];
+        var xhr = this._fetchSync("modules/" + (packData.url || packData.file));
+        this._writePackContents(packData.modules, JSON.parse(xhr.responseText));
+      }
+    }
+    for (var modname in toLoad) {
+      var moddata = this._allModules[modname];
+      if (this._loadedModules[modname] || moddata.dir) {
+        continue;
+      }
+      var xhr = this._fetchSync("modules/" + (moddata.url || moddata.file));
+      this._writeModuleFile(modname, xhr.responseText);
+      var pycURL = moddata.pyc_url || moddata.pyc;
+      if (pycURL) {
+        xhr = this._fetchSync("modules/" + pycURL, "arraybuffer");
+        this._writeModuleBytecode(modname, new Uint8Array(xhr.response));
+      }
+    }
+  } catch (err) {
+    if (err instanceof PyPyJS.Error && err.name === "ImportError") {
+      return err.message;
+    }
+    return "failed to load module data for " + name + ": " +
+           (err && err.message || String(err));
+  }
+  return "";
+}
+
+
+PyPyJS.prototype._recordModuleTrace = function _recordModuleTrace(toLoad) {
+  if (this._moduleTrace) {
+    for (var name in toLoad) {
+      if (!this._moduleTraceSeen[name]) {
+        this._moduleTraceSeen[name] = true;
+        this._moduleTrace.push(name);
+      }
+    }
+  }
+}
+
+
+// Run a function that fetches some files, once there are few enough
+// fetches in flight.  This limit applies across all concurrent calls
+// to loadModuleData, so we don't flood the network with requests.
+// Returns a promise that resolves or rejects along with the function.
+//
+PyPyJS.prototype._queueFetch = function _queueFetch(fn) {
+  return new Promise((function(resolve, reject) {
+    this._fetchQueue.push(function() {
+      var p;
+      try {
+        p = fn();
+      } catch (err) {
+        p = Promise.reject(err);
+      }
+      p.then(resolve, reject);
+      return p;
+    });
+    this._runFetchQueue();
   }).bind(this));
 }
 
 
-PyPyJS.prototype._findModuleDeps = function _findModuleDeps(name, seen) {
+PyPyJS.prototype._runFetchQueue = function _runFetchQueue() {
+  var done = (function() {
+    this._fetchesInFlight--;
+    this._runFetchQueue();
+  }).bind(this);
+  while (this._fetchQueue.length &&
+         this._fetchesInFlight < this.maxConcurrentFetches) {
+    var task = this._fetchQueue.shift();
+    this._fetchesInFlight++;
+    task().then(done, done);
+  }
+}
+
+
+// Methods to access the trace of loaded modules.
+//
+// If the VM was created with the "recordModuleTrace" option, these give
+// the names of all modules loaded so far in the order they were needed.
+// The saved trace files can be passed to "module_bundler.py preload-trace"
+// to generate a set of preloaded modules.
+//
+PyPyJS.prototype.getModuleTrace = function getModuleTrace() {
+  if (!this._moduleTrace) {
+    throw new PyPyJS.Error("module trace recording is not enabled");
+  }
+  return { modules: this._moduleTrace.slice() };
+}
+
+PyPyJS.prototype.saveModuleTrace = function saveModuleTrace(filename) {
+  var data = JSON.stringify(this.getModuleTrace(), null, 2);
+  // For nodejs, write it to a file.
+  if (typeof fs !== "undefined" && typeof fs.writeFile !== "undefined") {
+    return new Promise(function(resolve, reject) {
+      fs.writeFile(filename, data, function(err) {
+        if (err) return reject(err);
+        resolve();
+      });
+    });
+  }
+  // For the web, offer it as a download.
+  if (typeof document !== "undefined" && typeof Blob !== "undefined") {
+    var url = URL.createObjectURL(new Blob([data], {type: "application/json"}));
+    var link = document.createElement("a");
+    link.href = url;
+    link.download = filename || "pypyjs-trace.json";
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+    URL.revokeObjectURL(url);
+    return Promise.resolve();
+  }
+  return Promise.reject(new PyPyJS.Error("unable to save files"));
+}
+
+
+// Find all the dependencies of the given modules.
+// Returns a promise that resolves to an object with each needed module
+// name as a key.  With a split index, this fetches any shards of module
+// metadata that turn out to be needed while following the dependencies.
+//
+PyPyJS.prototype._findAllModuleDeps = function _findAllModuleDeps(names) {
+  var toLoad = {};
+  var shards = {};
+  for (var i = 0; i < names.length; i++) {
+    this._findModuleDeps(names[i], toLoad, shards);
+  }
+  var shardNames = Object.keys(shards);
+  if (!shardNames.length) {
+    return Promise.resolve(toLoad);
+  }
+  return this._loadIndexShards(shardNames).then((function() {
+    return this._findAllModuleDeps(names);
+  }).bind(this));
+}
+
+
+PyPyJS.prototype._findModuleDeps = function _findModuleDeps(name, seen, shards) {
   if (!seen) seen = {};
   var deps = [];
   // If we don't know about this module, ignore it.
+  // It may be that we haven't yet fetched its metadata.
   if (!this._allModules[name]) {
+    var shardName = name.split(".")[0];
+    if (shards && this._allShards[shardName]) {
+      shards[shardName] = true;
+    }
     return seen;
   }
   // Depend on any explicitly-named imports.
@@ -823,13 +1849,76 @@ PyPyJS.prototype._findModuleDeps = function _findModuleDeps(name, seen) {
   seen[name] = true;
   for (var i = 0; i < deps.length; i++) {
     if (!seen[deps[i]]) {
-      this._findModuleDeps(deps[i], seen);
+      this._findModuleDeps(deps[i], seen, shards);
     }
   }
   return seen;
 }
 
 
+// Fetch the shards of a split index that hold the metadata for
+// the top-level packages of the given module names.
+//
+PyPyJS.prototype._loadIndexShards = function _loadIndexShards(names) {
+  var ps = [];
+  for (var i = 0; i < names.length; i++) {
+    var shardName = names[i].split(".")[0];
+    var shardData = this._allShards[shardName];
+    if (!shardData) {
+      continue;
+    }
+    if (!this._pendingShards[shardName]) {
+      this._pendingShards[shardName] = this.fetch(
+        "modules/" + (shardData.url || shardData.file)
+      ).then((function(shardName, xhr) {
+        this._addIndexModules(JSON.parse(xhr.responseText).modules);
+        delete this._allShards[shardName];
+        delete this._pendingShards[shardName];
+      }).bind(this, shardName));
+    }
+    ps.push(this._pendingShards[shardName]);
+  }
+  return Promise.all(ps);
+}
+
+
+PyPyJS.prototype._loadIndexShardsSync = function _loadIndexShardsSync(names) {
+  for (var i = 0; i < names.length; i++) {
+    var shardName = names[i].split(".")[0];
+    var shardData = this._allShards[shardName];
+    if (!shardData) {
+      continue;
+    }
+    var xhr = this._fetchSync("modules/" + (shardData.url || shardData.file));
+    this._addIndexModules(JSON.parse(xhr.responseText).modules);
+    delete this._allShards[shardName];
+  }
+}
+
+
+// Add module metadata from a split index, in which each module name
+// is given by its position in the list of all module names.
+//
+PyPyJS.prototype._addIndexModules = function _addIndexModules(modules) {
+  for (var id in modules) {
+    var moddata = modules[id];
+    if (moddata.imports) {
+      moddata.imports = this._getModuleNames(moddata.imports);
+    }
+    this._allModules[this._moduleNames[id]] = moddata;
+  }
+}
+
+
+PyPyJS.prototype._getModuleNames = function _getModuleNames(ids) {
+  var names = [];
+  for (var i = 0; i < ids.length; i++) {
+    names.push(this._moduleNames[ids[i]]);
+  }
+  return names;
+}
+
+
 PyPyJS.prototype._makeLoadModuleData = function _makeLoadModuleData(name) {
   return (function() {
     // If we've already loaded this module, we're done.
@@ -845,12 +1934,25 @@ PyPyJS.prototype._makeLoadModuleData = function _makeLoadModuleData(name) {
       return Promise.resolve();
     }
     // We need to fetch the module file and write it out.
-    var modfile = this._allModules[name].file;
-    var p = this.fetch("modules/" + modfile)
-    .then((function(xhr) {
-      var contents = xhr.responseText;
-      this._writeModuleFile(name, contents)
+    // If there's compiled bytecode for it, fetch that at the same time.
+    // Files may have a content-addressed url, which we prefer for caching.
+    var moddata = this._allModules[name];
+    var pycURL = moddata.pyc_url || moddata.pyc;
+    var p = Promise.all([
+      this.fetch("modules/" + (moddata.url || moddata.file)),
+      pycURL ? this.fetch("modules/" + pycURL, "arraybuffer") : null
+    ])
+    .then((function(xhrs) {
       delete this._pendingModules[name];
+      // The import hook may have loaded it while we were waiting.
+      if (this._loadedModules[name]) {
+        return;
+      }
+      var contents = xhrs[0].responseText;
+      this._writeModuleFile(name, contents)
+      if (xhrs[1]) {
+        this._writeModuleBytecode(name, new Uint8Array(xhrs[1].response));
+      }
     }).bind(this))
     this._pendingModules[name] = p;
     return p;
@@ -858,6 +1960,101 @@ PyPyJS.prototype._makeLoadModuleData = function _makeLoadModuleData(name) {
 }
 
 
+// Check whether all the outstanding modules in a pack are needed.
+// If so then it's cheaper to fetch the pack than its individual modules.
+//
+PyPyJS.prototype._isPackNeeded = function _isPackNeeded(packName, toLoad) {
+  var packModules = this._allPacks[packName].modules;
+  var outstanding = false;
+  for (var i = 0; i < packModules.length; i++) {
+    var name = packModules[i];
+    if (this._loadedModules[name] || this._pendingModules[name]) {
+      continue;
+    }
+    if (!toLoad[name]) {
+      return false;
+    }
+    outstanding = true;
+  }
+  return outstanding;
+}
+
+
+PyPyJS.prototype._makeLoadPackData = function _makeLoadPackData(packName) {
+  return (function() {
+    // Claim all the modules in the pack that aren't already loaded
+    // or being loaded by some other request.
+    var packData = this._allPacks[packName];
+    var claimed = [];
+    for (var i = 0; i < packData.modules.length; i++) {
+      var name = packData.modules[i];
+      if (!this._loadedModules[name] && !this._pendingModules[name]) {
+        claimed.push(name);
+      }
+    }
+    if (!claimed.length) {
+      return Promise.resolve();
+    }
+    var p = this.fetch("modules/" + (packData.url || packData.file))
+    .then((function(xhr) {
+      for (var i = 0; i < claimed.length; i++) {
+        delete this._pendingModules[claimed[i]];
+      }
+      this._writePackContents(claimed, JSON.parse(xhr.responseText));
+    }).bind(this));
+    for (var i = 0; i < claimed.length; i++) {
+      this._pendingModules[claimed[i]] = p;
+    }
+    return p;
+  }).bind(this);
+}
+
+
+// Write out the given modules from the contents of a pack file,
+// skipping any that have already been loaded.
+//
+PyPyJS.prototype._writePackContents = function _writePackContents(names, contents) {
+  for (var i = 0; i < names.length; i++) {
+    var name = names[i];
+    if (this._loadedModules[name]) {
+      continue;
+    }
+    this._writeModuleFile(name, contents.modules[name]);
+    if (contents.bytecode && contents.bytecode[name]) {
+      var bytecode = _base64Decode(contents.bytecode[name]);
+      this._writeModuleBytecode(name, bytecode);
+    }
+  }
+}
+
+
+// Find the url of a support file such as the memory initializer,
+// relative to the root url.  The module index may map it to a
+// content-addressed copy in the modules directory.
+//
+PyPyJS.prototype._locateFile = function _locateFile(name) {
+  if (this._fileNames[name]) {
+    return "modules/" + this._fileNames[name];
+  }
+  return name;
+}
+
+
+// Mount the bundled modules directory from disk using emscripten's NODEFS,
+// so that modules are read straight from their files as they're imported
+// rather than being copied into the VM's memory.
+//
+PyPyJS.prototype._mountModuleDir = function _mountModuleDir() {
+  var Module = this._module;
+  if (!Module.NODEFS || typeof path === "undefined") {
+    throw new PyPyJS.Error("mounting modules is only supported in nodejs");
+  }
+  var rootURL = this.rootURL || PyPyJS.rootURL;
+  var moduleDir = path.resolve(rootURL, "modules");
+  this._FS.mount(Module.NODEFS, { root: moduleDir }, "/lib/pypyjs/lib_pypy");
+}
+
+
 PyPyJS.prototype._writeModuleFile = function _writeModuleFile(name, data) {
   var Module = this._module;
   var file = this._allModules[name].file;
@@ -869,10 +2066,1038 @@ PyPyJS.prototype._writeModuleFile = function _writeModuleFile(name, data) {
   // Now we can safely create the file.
   var fullpath = "/lib/pypyjs/lib_pypy/" + file;
   Module.FS_createDataFile(fullpath, "", data, true, false, true);
+  // If there's compiled bytecode for it, the VM will only use it if the
+  // source file has the same mtime as was recorded in the bytecode.
+  var mtime = this._allModules[name].mtime;
+  if (mtime) {
+    this._FS.utime(fullpath, mtime * 1000, mtime * 1000);
+  }
   this._loadedModules[name] = true;
 }
 
 
+PyPyJS.prototype._writeModuleBytecode = function _writeModuleBytecode(name, data) {
+  var Module = this._module;
+  var fullpath = "/lib/pypyjs/lib_pypy/" + this._allModules[name].pyc;
+  Module.FS_createDataFile(fullpath, "", data, true, false, true);
+}
+
+
+// Decode a base64-encoded string into a Uint8Array.
+// We use the builtin decoders where available and fall back to doing it
+// by hand, which is slow but only used for small amounts of preload data.
+
+var base64Chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+function _base64Decode(data) {
+  if (typeof Buffer !== "undefined" && typeof Buffer.from === "function") {
+    return new Uint8Array(Buffer.from(data, "base64"));
+  }
+  if (typeof atob !== "undefined") {
+    var str = atob(data);
+    var bytes = new Uint8Array(str.length);
+    for (var i = 0; i < str.length; i++) {
+      bytes[i] = str.charCodeAt(i);
+    }
+    return bytes;
+  }
+  data = data.replace(/[^A-Za-z0-9\+\/]/g, "");
+  var bytes = new Uint8Array(Math.floor(data.length * 3 / 4));
+  var j = 0, bits = 0, nbits = 0;
+  for (var i = 0; i < data.length; i++) {
+    bits = (bits << 6) | base64Chars.indexOf(data.charAt(i));
+    nbits += 6;
+    if (nbits >= 8) {
+      nbits -= 8;
+      bytes[j++] = (bits >> nbits) & 0xFF;
+    }
+  }
+  return bytes;
+}
+
+
+// A pool of interpreters that are kept started and ready for use.
+//
+// This is useful for e.g. servers that want a fresh interpreter for each
+// request, without paying the cost of starting one each time.  Between
+// uses, each interpreter's top-level scope is cleared and its IO streams
+// are restored.  Other state such as imported modules can still leak from
+// one use to the next, so each interpreter is replaced with a new one once
+// it has been used "maxUses" times.
+//
+// Options are "size", "maxUses", "vmOptions" to pass to the constructor of
+// each interpreter, and "snapshot" to start them from a snapshot instead.
+
+PyPyJS.Pool = function Pool(opts) {
+  opts = opts || {};
+  this.size = opts.size || 4;
+  this.maxUses = opts.maxUses || 100;
+  this.vmOptions = opts.vmOptions || {};
+  this.snapshot = opts.snapshot || null;
+  this._idle = [];
+  this._waiting = [];
+  this._starting = 0;
+  this._busy = 0;
+  this._closed = false;
+  // The interpreters that have been handed out, by their id in the pool.
+  this._checkedOut = {};
+  this._nextID = 0;
+  this._stats = {
+    acquired: 0,
+    created: 0,
+    recycled: 0,
+    waited: 0,
+    totalWaitTime: 0,
+    maxWaitTime: 0
+  };
+  var ps = [];
+  for (var i = 0; i < this.size; i++) {
+    ps.push(this._startVM());
+  }
+  this.ready = Promise.all(ps).then(function() {});
+}
+
+// Get an interpreter from the pool, waiting for one to become
+// available if necessary.  Returns a promise for the interpreter,
+// which must be given back to the pool with release() when done.
+PyPyJS.Pool.prototype.acquire = function acquire() {
+  if (this._closed) {
+    return Promise.reject(new PyPyJS.Error("pool is closed"));
+  }
+  this._stats.acquired++;
+  if (this._idle.length) {
+    return Promise.resolve(this._checkOut(this._idle.pop()));
+  }
+  // Replace any interpreters that previously failed to start.
+  if (this._idle.length + this._busy + this._starting < this.size) {
+    this._startVM().then(null, function() {});
+  }
+  return new Promise((function(resolve, reject) {
+    this._waiting.push({ resolve: resolve, reject: reject, start: Date.now() });
+  }).bind(this));
+}
+
+// Give an interpreter back to the pool.  Returns a promise that
+// resolves once it has been reset and is available for re-use.
+PyPyJS.Pool.prototype.release = function release(vm) {
+  if (!vm || this._checkedOut[vm._poolID] !== vm) {
+    throw new PyPyJS.Error("interpreter was not acquired from this pool");
+  }
+  delete this._checkedOut[vm._poolID];
+  this._busy--;
+  vm.stdin = vm._poolIO.stdin;
+  vm.stdout = vm._poolIO.stdout;
+  vm.stderr = vm._poolIO.stderr;
+  vm._poolUses++;
+  if (this._closed) {
+    return Promise.resolve();
+  }
+  if (vm._poolUses >= this.maxUses) {
+    this._recycle();
+    return Promise.resolve();
+  }
+  this._busy++;
+  var code = "top_level_scope.clear(); top_level_scope['__name__'] = '__main__'";
+  return vm._execute_source(code).then((function() {
+    this._busy--;
+    this._makeAvailable(vm);
+  }).bind(this), (function() {
+    this._busy--;
+    this._recycle();
+  }).bind(this));
+}
+
+// Run a function with an interpreter from the pool, giving it back when
+// the function is done.  Returns a promise for the function's result.
+PyPyJS.Pool.prototype.use = function use(fn) {
+  return this.acquire().then((function(vm) {
+    return Promise.resolve().then(function() {
+      return fn(vm);
+    }).then((function(result) {
+      return this.release(vm).then(function() {
+        return result;
+      });
+    }).bind(this), (function(err) {
+      return this.release(vm).then(function() {
+        throw err;
+      });
+    }).bind(this));
+  }).bind(this));
+}
+
+// Stop handing out interpreters, and let go of the idle ones.
+PyPyJS.Pool.prototype.close = function close() {
+  this._closed = true;
+  this._idle = [];
+  var waiting = this._waiting;
+  this._waiting = [];
+  for (var i = 0; i < waiting.length; i++) {
+    waiting[i].reject(new PyPyJS.Error("pool is closed"));
+  }
+}
+
+PyPyJS.Pool.prototype.getStats = function getStats() {
+  var stats = this._stats;
+  return {
+    size: this.size,
+    idle: this._idle.length,
+    busy: this._busy,
+    starting: this._starting,
+    queueDepth: this._waiting.length,
+    acquired: stats.acquired,
+    created: stats.created,
+    recycled: stats.recycled,
+    waited: stats.waited,
+    averageWaitTime: stats.waited ? stats.totalWaitTime / stats.waited : 0,
+    maxWaitTime: stats.maxWaitTime
+  };
+}
+
+PyPyJS.Pool.prototype._startVM = function _startVM() {
+  this._starting++;
+  this._stats.created++;
+  var vm;
+  if (this.snapshot) {
+    vm = this.snapshot.spawn(this.vmOptions);
+  } else {
+    vm = new PyPyJS(this.vmOptions);
+  }
+  vm._poolID = this._nextID++;
+  vm._poolUses = 0;
+  vm._poolIO = { stdin: vm.stdin, stdout: vm.stdout, stderr: vm.stderr };
+  return vm.ready.then((function() {
+    this._starting--;
+    this._makeAvailable(vm);
+  }).bind(this), (function(err) {
+    this._starting--;
+    // Don't leave anyone waiting for an interpreter that won't come.
+    if (this._idle.length + this._busy + this._starting === 0) {
+      var waiting = this._waiting;
+      this._waiting = [];
+      for (var i = 0; i < waiting.length; i++) {
+        waiting[i].reject(err);
+      }
+    }
+    throw err;
+  }).bind(this));
+}
+
+PyPyJS.Pool.prototype._recycle = function _recycle() {
+  this._stats.recycled++;
+  this._startVM().then(null, function() {});
+}
+
+PyPyJS.Pool.prototype._makeAvailable = function _makeAvailable(vm) {
+  if (this._closed) {
+    return;
+  }
+  if (this._waiting.length) {
+    var waiter = this._waiting.shift();
+    var waitTime = Date.now() - waiter.start;
+    this._stats.waited++;
+    this._stats.totalWaitTime += waitTime;
+    this._stats.maxWaitTime = Math.max(this._stats.maxWaitTime, waitTime);
+    waiter.resolve(this._checkOut(vm));
+  } else {
+    this._idle.push(vm);
+  }
+}
+
+PyPyJS.Pool.prototype._checkOut = function _checkOut(vm) {
+  this._busy++;
+  this._checkedOut[vm._poolID] = vm;
+  return vm;
+}
+
+
+// Snapshots of the state of a freshly-started VM.
+//
+// Starting a VM from a snapshot skips the whole of the interpreter's
+// startup process, and just copies the heap and filesystem into place.
+// Use PyPyJS.createSnapshot() to make one and "snapshot.spawn()" to start
+// new VMs from it.
+//
+// The snapshot is taken before the "js" module is imported, because the
+// handles it makes to javascript objects can't be copied into another VM.
+// It includes the whole filesystem apart from /dev and /proc, which the
+// runtime sets up for itself, and re-opens any files that were left open.
+
+PyPyJS.createSnapshot = function createSnapshot(opts) {
+  opts = opts || {};
+  var cache = opts.persistSnapshot ? opts.cache : null;
+  var key = opts.snapshotKey || "pypyjs-snapshot";
+  var snapshotP = Promise.resolve(null);
+  if (cache) {
+    // A saved snapshot refers to the files of the bundle it was made from,
+    // which may be gone once the bundle is rebuilt, so we only use it with
+    // the exact same module index.
+    snapshotP = _fetchBundleID(opts).then(function(bundleID) {
+      return PyPyJS.Snapshot.load(cache, key, bundleID);
+    }).then(null, function() {
+      return null;
+    });
+  }
+  return snapshotP.then(function(snapshot) {
+    if (snapshot) {
+      return snapshot;
+    }
+    var vm = _newSnapshotVM(opts);
+    return vm.ready.then(function() {
+      snapshot = vm._takenSnapshot;
+      // The snapshot is only valid for the exact VM code that made it,
+      // so we only persist it if that code has a content-addressed name.
+      if (!cache || !/(^|\/)hashed\//.test(snapshot.vmFile)) {
+        return snapshot;
+      }
+      return snapshot.save(cache, key).then(function() {
+        return snapshot;
+      }, function(err) {
+        debug("Failed to save snapshot: " + err);
+        return snapshot;
+      });
+    });
+  });
+}
+
+// Make a VM that takes a snapshot of itself as soon as it has started.
+function _newSnapshotVM(opts) {
+  var vm = Object.create(PyPyJS.prototype);
+  vm._takeSnapshot = true;
+  PyPyJS.call(vm, opts);
+  return vm;
+}
+
+// Identify a bundle of modules by the contents of its module index.
+function _bundleID(indexText) {
+  var hash = 0x811c9dc5;
+  for (var i = 0; i < indexText.length; i++) {
+    hash ^= indexText.charCodeAt(i);
+    hash = Math.imul ? Math.imul(hash, 0x01000193) : (hash * 0x01000193) | 0;
+  }
+  return indexText.length + "-" + (hash >>> 0).toString(16);
+}
+
+function _fetchBundleID(opts) {
+  var fetcher = Object.create(PyPyJS.prototype);
+  fetcher.rootURL = opts.rootURL || PyPyJS.rootURL || __dirname;
+  if (fetcher.rootURL.charAt(fetcher.rootURL.length - 1) !== "/") {
+    fetcher.rootURL += "/";
+  }
+  fetcher.cache = opts.cache || null;
+  return fetcher.fetch("modules/index.json").then(function(xhr) {
+    return _bundleID(xhr.responseText);
+  });
+}
+
+// The runtime creates these itself, so they aren't copied.
+var SNAPSHOT_SKIP_PATHS = { "/dev": true, "/proc": true };
+
+// Flags that mustn't be used again when re-opening a file.
+var O_CREAT = 64, O_EXCL = 128, O_TRUNC = 512;
+
+PyPyJS.Snapshot = function Snapshot(vm) {
+  var Module = vm._module;
+  this.rootURL = vm.rootURL;
+  this.bundleID = vm._bundleID;
+  // The heap may have grown, and new VMs must start at the same size.
+  this.totalMemory = Module.HEAPU8.length;
+  this.vmFile = vm._locateFile("pypy.vm.js");
+  // If we can find the top of the heap then we needn't copy the
+  // unused memory above it.
+  this.dynamicTop = Module._getDynamicTop ? Module._getDynamicTop() : null;
+  var top = this.dynamicTop === null ? Module.HEAPU8.length : this.dynamicTop;
+  this.heap = new Uint8Array(Module.HEAPU8.subarray(0, top));
+  // Mounted modules are mounted again in each new VM, not copied.
+  this.mountModules = vm._mountModules;
+  this.files = [];
+  this._readFiles(vm._FS, "/");
+  // Files opened by the interpreter itself, beyond stdin/stdout/stderr.
+  this.streams = [];
+  var streams = vm._FS.streams || [];
+  for (var fd = 3; fd < streams.length; fd++) {
+    var stream = streams[fd];
+    if (stream) {
+      this.streams.push({
+        fd: fd,
+        path: stream.path,
+        flags: stream.flags & ~(O_CREAT | O_EXCL | O_TRUNC),
+        position: stream.position
+      });
+    }
+  }
+  // Keep the metadata about available modules, and which are loaded.
+  this.fileNames = vm._fileNames;
+  this.modules = {};
+  for (var name in vm._allModules) {
+    this.modules[name] = vm._allModules[name];
+  }
+  this.packs = vm._allPacks;
+  this.shards = {};
+  for (var shardName in vm._allShards) {
+    this.shards[shardName] = vm._allShards[shardName];
+  }
+  this.moduleNames = vm._moduleNames;
+  this.loadedModules = Object.keys(vm._loadedModules);
+}
+
+PyPyJS.Snapshot.prototype._readFiles = function _readFiles(FS, dir) {
+  var names = FS.readdir(dir);
+  for (var i = 0; i < names.length; i++) {
+    if (names[i] === "." || names[i] === "..") {
+      continue;
+    }
+    var filepath = (dir === "/" ? "" : dir) + "/" + names[i];
+    if (SNAPSHOT_SKIP_PATHS[filepath]) {
+      continue;
+    }
+    var st = FS.stat(filepath);
+    if (FS.isDir(st.mode)) {
+      this.files.push({ path: filepath, dir: true });
+      if (this.mountModules && filepath === "/lib/pypyjs/lib_pypy") {
+        continue;
+      }
+      this._readFiles(FS, filepath);
+    } else {
+      this.files.push({
+        path: filepath,
+        mtime: st.mtime.getTime(),
+        data: FS.readFile(filepath, { encoding: "binary" })
+      });
+    }
+  }
+}
+
+// Start a new VM from the snapshot.
+// This takes the same options as the PyPyJS constructor.
+PyPyJS.Snapshot.prototype.spawn = function spawn(opts) {
+  var vmOpts = {};
+  for (var k in opts) {
+    vmOpts[k] = opts[k];
+  }
+  vmOpts.snapshot = this;
+  return new PyPyJS(vmOpts);
+}
+
+PyPyJS.Snapshot.prototype._restoreModuleData = function _restoreModuleData(vm) {
+  for (var name in this.modules) {
+    vm._allModules[name] = this.modules[name];
+  }
+  vm._allPacks = this.packs;
+  for (var shardName in this.shards) {
+    vm._allShards[shardName] = this.shards[shardName];
+  }
+  vm._moduleNames = this.moduleNames;
+  for (var i = 0; i < this.loadedModules.length; i++) {
+    vm._loadedModules[this.loadedModules[i]] = true;
+  }
+}
+
+PyPyJS.Snapshot.prototype._restore = function _restore(vm) {
+  var Module = vm._module;
+  var FS = vm._FS;
+  for (var i = 0; i < this.files.length; i++) {
+    var file = this.files[i];
+    if (file.dir) {
+      try {
+        FS.mkdir(file.path);
+      } catch (e) { }
+    } else {
+      try {
+        Module.FS_createDataFile(file.path, "", file.data, true, false, false);
+      } catch (e) {
+        // The runtime already made this file, so just replace its contents.
+        FS.writeFile(file.path, file.data, { encoding: "binary" });
+      }
+      FS.utime(file.path, file.mtime, file.mtime);
+    }
+  }
+  var streams = this.streams || [];
+  for (var i = 0; i < streams.length; i++) {
+    var saved = streams[i];
+    var stream = FS.open(saved.path, saved.flags, 0, saved.fd, saved.fd);
+    if (stream.fd !== saved.fd) {
+      throw new PyPyJS.Error("could not re-open file descriptor " + saved.fd);
+    }
+    stream.position = saved.position;
+  }
+  Module.HEAPU8.set(this.heap);
+  if (this.dynamicTop !== null) {
+    Module._setDynamicTop(this.dynamicTop);
+  }
+}
+
+// Save the snapshot into a persistent cache, and load it back again.
+// The file data is stored along with the heap in one big binary blob,
+// and everything else is stored as JSON.
+
+PyPyJS.Snapshot.prototype.save = function save(cache, key) {
+  var meta = {
+    rootURL: this.rootURL,
+    bundleID: this.bundleID,
+    streams: this.streams,
+    totalMemory: this.totalMemory,
+    mountModules: this.mountModules,
+    vmFile: this.vmFile,
+    dynamicTop: this.dynamicTop,
+    heapSize: this.heap.length,
+    files: [],
+    fileNames: this.fileNames,
+    modules: this.modules,
+    packs: this.packs,
+    shards: this.shards,
+    moduleNames: this.moduleNames,
+    loadedModules: this.loadedModules
+  };
+  var size = this.heap.length;
+  for (var i = 0; i < this.files.length; i++) {
+    var file = this.files[i];
+    if (file.dir) {
+      meta.files.push({ path: file.path, dir: true });
+    } else {
+      meta.files.push({ path: file.path, mtime: file.mtime, size: file.data.length });
+      size += file.data.length;
+    }
+  }
+  var blob = new Uint8Array(size);
+  blob.set(this.heap);
+  var offset = this.heap.length;
+  for (var i = 0; i < this.files.length; i++) {
+    if (!this.files[i].dir) {
+      blob.set(this.files[i].data, offset);
+      offset += this.files[i].data.length;
+    }
+  }
+  // Write the blob first, so that we never find metadata without it.
+  return cache.put(key + ".bin", blob.buffer).then(function() {
+    return cache.put(key + ".json", JSON.stringify(meta));
+  });
+}
+
+// If a bundle id is given, a snapshot of any other bundle is ignored.
+PyPyJS.Snapshot.load = function load(cache, key, bundleID) {
+  return cache.get(key + ".json", "text").then(function(metaText) {
+    if (!metaText) {
+      return null;
+    }
+    var meta = JSON.parse(metaText);
+    if (bundleID && meta.bundleID !== bundleID) {
+      return null;
+    }
+    return cache.get(key + ".bin", "arraybuffer").then(function(buffer) {
+      if (!buffer) {
+        return null;
+      }
+      var snapshot = Object.create(PyPyJS.Snapshot.prototype);
+      for (var k in meta) {
+        snapshot[k] = meta[k];
+      }
+      var blob = new Uint8Array(buffer);
+      snapshot.heap = blob.subarray(0, meta.heapSize);
+      var offset = meta.heapSize;
+      for (var i = 0; i < snapshot.files.length; i++) {
+        var file = snapshot.files[i];
+        if (!file.dir) {
+          file.data = blob.subarray(offset, offset + file.size);
+          offset += file.size;
+          delete file.size;
+        }
+      }
+      delete snapshot.heapSize;
+      return snapshot;
+    });
+  });
+}
+
+
+// Persistent caches for fetched files, to pass as the "cache" option.
+//
+// A cache just needs "get(key, responseType)" and "put(key, data)" methods
+// that return promises, where the data is a string or an ArrayBuffer and
+// "get" gives null for missing keys.  This base class implements those on
+// top of a simpler storage interface, keeping the total size of the cached
+// data under "maxSize" bytes by evicting the least-recently-used files.
+
+PyPyJS.Cache = function Cache(opts) {
+  opts = opts || {};
+  this.maxSize = opts.maxSize || 256 * 1024 * 1024;
+  this._entriesP = null;
+}
+
+PyPyJS.Cache.prototype.get = function get(key, responseType) {
+  return this._getEntries().then((function(entries) {
+    var entry = entries[key];
+    if (!entry) {
+      return null;
+    }
+    entry.atime = Date.now();
+    return this._read(key, responseType).then((function(data) {
+      this._touch(key, entry).then(null, function() {});
+      return data;
+    }).bind(this), function() {
+      delete entries[key];
+      return null;
+    });
+  }).bind(this));
+}
+
+// Read from the cache synchronously, where the storage allows it.
+// This is used for the files fetched by the import hook.
+PyPyJS.Cache.prototype.getSync = function getSync(key, responseType) {
+  if (!this._readSync) {
+    return null;
+  }
+  try {
+    return this._readSync(key, responseType);
+  } catch (err) {
+    return null;
+  }
+}
+
+PyPyJS.Cache.prototype.put = function put(key, data) {
+  var size = typeof data === "string" ? _utf8Length(data) : data.byteLength;
+  if (size > this.maxSize) {
+    return Promise.resolve();
+  }
+  return this._getEntries().then((function(entries) {
+    var entry = { size: size, atime: Date.now() };
+    return this._write(key, data, entry).then((function() {
+      entries[key] = entry;
+      return this._evict(entries);
+    }).bind(this));
+  }).bind(this));
+}
+
+PyPyJS.Cache.prototype._getEntries = function _getEntries() {
+  if (!this._entriesP) {
+    this._entriesP = this._readEntries();
+  }
+  return this._entriesP;
+}
+
+PyPyJS.Cache.prototype._evict = function _evict(entries) {
+  var total = 0;
+  var keys = Object.keys(entries);
+  for (var i = 0; i < keys.length; i++) {
+    total += entries[keys[i]].size;
+  }
+  keys.sort(function(a, b) {
+    return entries[a].atime - entries[b].atime;
+  });
+  var ps = [];
+  for (var i = 0; i < keys.length && total > this.maxSize; i++) {
+    total -= entries[keys[i]].size;
+    delete entries[keys[i]];
+    ps.push(this._delete(keys[i]));
+  }
+  return Promise.all(ps);
+}
+
+
+// A cache that keeps files in the browser's IndexedDB storage.
+// File data and access times are kept in separate object stores,
+// so that we don't have to rewrite the data to update the access time.
+
+PyPyJS.IndexedDBCache = function IndexedDBCache(opts) {
+  PyPyJS.Cache.call(this, opts);
+  opts = opts || {};
+  this.name = opts.name || "pypyjs-cache";
+  this._dbP = null;
+}
+PyPyJS.IndexedDBCache.prototype = Object.create(PyPyJS.Cache.prototype);
+PyPyJS.IndexedDBCache.prototype.constructor = PyPyJS.IndexedDBCache;
+
+PyPyJS.IndexedDBCache.prototype._getDB = function _getDB() {
+  if (!this._dbP) {
+    this._dbP = new Promise((function(resolve, reject) {
+      if (typeof indexedDB === "undefined") {
+        throw new PyPyJS.Error("IndexedDB is not available");
+      }
+      var req = indexedDB.open(this.name, 1);
+      req.onupgradeneeded = function() {
+        req.result.createObjectStore("data");
+        req.result.createObjectStore("entries");
+      };
+      req.onsuccess = function() { resolve(req.result); };
+      req.onerror = function() { reject(req.error); };
+    }).bind(this));
+  }
+  return this._dbP;
+}
+
+PyPyJS.IndexedDBCache.prototype._transact = function _transact(mode, fn) {
+  return this._getDB().then(function(db) {
+    return new Promise(function(resolve, reject) {
+      var tx = db.transaction(["data", "entries"], mode);
+      var result = fn(tx.objectStore("data"), tx.objectStore("entries"));
+      tx.oncomplete = function() {
+        resolve(result ? result.result : undefined);
+      };
+      tx.onerror = tx.onabort = function() { reject(tx.error); };
+    });
+  });
+}
+
+PyPyJS.IndexedDBCache.prototype._readEntries = function _readEntries() {
+  var entries = {};
+  return this._transact("readonly", function(data, store) {
+    store.openCursor().onsuccess = function(evt) {
+      var cursor = evt.target.result;
+      if (cursor) {
+        entries[cursor.key] = cursor.value;
+        cursor.continue();
+      }
+    };
+  }).then(function() {
+    return entries;
+  });
+}
+
+PyPyJS.IndexedDBCache.prototype._read = function _read(key, responseType) {
+  return this._transact("readonly", function(data, store) {
+    return data.get(key);
+  }).then(function(data) {
+    if (typeof data === "undefined") {
+      throw new PyPyJS.Error("missing cache data for " + key);
+    }
+    return data;
+  });
+}
+
+PyPyJS.IndexedDBCache.prototype._write = function _write(key, value, entry) {
+  return this._transact("readwrite", function(data, store) {
+    data.put(value, key);
+    store.put(entry, key);
+  });
+}
+
+PyPyJS.IndexedDBCache.prototype._touch = function _touch(key, entry) {
+  return this._transact("readwrite", function(data, store) {
+    store.put(entry, key);
+  });
+}
+
+PyPyJS.IndexedDBCache.prototype._delete = function _delete(key) {
+  return this._transact("readwrite", function(data, store) {
+    data.delete(key);
+    store.delete(key);
+  });
+}
+
+
+// A cache that keeps files in a directory, for nodejs.
+// Each file's mtime is used as its access time.
+
+PyPyJS.DirectoryCache = function DirectoryCache(dirname, opts) {
+  PyPyJS.Cache.call(this, opts);
+  if (typeof fs === "undefined") {
+    throw new PyPyJS.Error("DirectoryCache requires nodejs");
+  }
+  this.dirname = dirname;
+}
+PyPyJS.DirectoryCache.prototype = Object.create(PyPyJS.Cache.prototype);
+PyPyJS.DirectoryCache.prototype.constructor = PyPyJS.DirectoryCache;
+
+PyPyJS.DirectoryCache.prototype._path = function _path(key) {
+  return path.join(this.dirname, encodeURIComponent(key));
+}
+
+PyPyJS.DirectoryCache.prototype._readEntries = function _readEntries() {
+  var dirname = this.dirname;
+  return new Promise(function(resolve, reject) {
+    fs.mkdir(dirname, { recursive: true }, function(err) {
+      if (err && err.code !== "EEXIST") return reject(err);
+      fs.readdir(dirname, function(err, names) {
+        if (err) return reject(err);
+        var entries = {};
+        for (var i = 0; i < names.length; i++) {
+          // Skip any partially-written files.
+          if (names[i].charAt(0) === ".") continue;
+          try {
+            var st = fs.statSync(path.join(dirname, names[i]));
+          } catch (e) {
+            continue;
+          }
+          entries[decodeURIComponent(names[i])] = {
+            size: st.size,
+            atime: st.mtime.getTime()
+          };
+        }
+        resolve(entries);
+      });
+    });
+  });
+}
+
+PyPyJS.DirectoryCache.prototype._read = function _read(key, responseType) {
+  var filepath = this._path(key);
+  return new Promise(function(resolve, reject) {
+    fs.readFile(filepath, function(err, data) {
+      if (err) return reject(err);
+      if (responseType === "arraybuffer") {
+        resolve(new Uint8Array(data).buffer);
+      } else {
+        resolve(data.toString());
+      }
+    });
+  });
+}
+
+PyPyJS.DirectoryCache.prototype._readSync = function _readSync(key, responseType) {
+  var data = fs.readFileSync(this._path(key));
+  if (responseType === "arraybuffer") {
+    return new Uint8Array(data).buffer;
+  }
+  return data.toString();
+}
+
+PyPyJS.DirectoryCache.prototype._write = function _write(key, data, entry) {
+  var filepath = this._path(key);
+  var tmppath = path.join(this.dirname, "." + encodeURIComponent(key) +
+                          "." + process.pid + ".tmp");
+  if (typeof data !== "string") {
+    data = new Uint8Array(data);
+  }
+  // Write to a temporary file then rename it into place, so that
+  // other processes sharing the cache never see a partial file.
+  return new Promise(function(resolve, reject) {
+    fs.writeFile(tmppath, data, function(err) {
+      if (err) return reject(err);
+      fs.rename(tmppath, filepath, function(err) {
+        if (err) return reject(err);
+        resolve();
+      });
+    });
+  });
+}
+
+PyPyJS.DirectoryCache.prototype._touch = function _touch(key, entry) {
+  var filepath = this._path(key);
+  return new Promise(function(resolve, reject) {
+    var atime = entry.atime / 1000;
+    fs.utimes(filepath, atime, atime, function(err) {
+      if (err) return reject(err);
+      resolve();
+    });
+  });
+}
+
+PyPyJS.DirectoryCache.prototype._delete = function _delete(key) {
+  var filepath = this._path(key);
+  return new Promise(function(resolve, reject) {
+    fs.unlink(filepath, function(err) {
+      if (err && err.code !== "ENOENT") return reject(err);
+      resolve();
+    });
+  });
+}
+
+
+// Run an interpreter in a web worker or nodejs worker thread.
+//
+// This offers the same promise-based API as a PyPyJS object, but runs the
+// interpreter on another thread so that long-running python code doesn't
+// block the calling thread, and several interpreters can run in parallel.
+// Output is sent back in batches and passed to the "stdout" and "stderr"
+// methods of this object.  Values passed to set(), and those returned from
+// get() and eval(), must be ones that can be copied between threads.
+//
+// Calling cancel() abandons any running code by terminating the worker, and
+// starts a fresh interpreter in its place.  Call terminate() when finished
+// with the interpreter, to stop the worker for good.
+//
+// Options are as for the PyPyJS constructor, except that "cache" and
+// "snapshot" are not supported, and stdin is always closed in the worker.
+// The "workerURL" option gives the location of the "pypy.worker.js" script,
+// which defaults to the same directory as this file.
+
+PyPyJS.Worker = function PyPyJSWorker(opts) {
+  opts = opts || {};
+  setDefaultIO(this);
+  this.stdin = opts.stdin || this.stdin;
+  this.stdout = opts.stdout || this.stdout;
+  this.stderr = opts.stderr || this.stderr;
+  this.autoLoadModules = opts.autoLoadModules !== false;
+  this._workerURL = opts.workerURL || __dirname + "pypy.worker.js";
+  // Pass on any options that can be copied to the worker.
+  this._workerOpts = {};
+  for (var k in opts) {
+    if (k === "cache" || k === "snapshot" || k === "workerURL") continue;
+    if (typeof opts[k] === "function") continue;
+    this._workerOpts[k] = opts[k];
+  }
+  this._workerOpts.rootURL = opts.rootURL || PyPyJS.rootURL || __dirname;
+  // Relative URLs would be resolved against the worker's own location.
+  if (typeof location !== "undefined" && typeof URL !== "undefined") {
+    this._workerURL = new URL(this._workerURL, location.href).href;
+    this._workerOpts.rootURL = new URL(this._workerOpts.rootURL, location.href).href;
+  }
+  this._worker = null;
+  this._pendingCalls = {};
+  this._nextCallID = 0;
+  this._start();
+}
+
+PyPyJS.Worker.prototype.exec = function exec(code) {
+  return this._call("exec", [code]);
+}
+
+PyPyJS.Worker.prototype.eval = function eval(expr) {
+  return this._call("eval", [expr]);
+}
+
+PyPyJS.Worker.prototype.execfile = function execfile(filename) {
+  return this._call("execfile", [filename]);
+}
+
+PyPyJS.Worker.prototype.get = function get(name, _fromGlobals) {
+  return this._call("get", [name, _fromGlobals]);
+}
+
+PyPyJS.Worker.prototype.getMany = function getMany(names) {
+  return this._call("getMany", [names]);
+}
+
+PyPyJS.Worker.prototype.setBuffer = function setBuffer(name, array) {
+  return this._call("setBuffer", [name, array]);
+}
+
+// The interpreter's memory can't be shared with this thread,
+// so this always gives a copy of the array's contents.
+PyPyJS.Worker.prototype.getBuffer = function getBuffer(name) {
+  return this._call("getBuffer", [name]);
+}
+
+PyPyJS.Worker.prototype.set = function set(name, value) {
+  return this._call("set", [name, value]);
+}
+
+PyPyJS.Worker.prototype.loadModuleData = function loadModuleData(/* names */) {
+  return this._call("loadModuleData", Array.prototype.slice.call(arguments));
+}
+
+PyPyJS.Worker.prototype._execute_source = function _execute_source(code) {
+  return this._call("_execute_source", [code]);
+}
+
+PyPyJS.Worker.prototype.getMemoryStats = function getMemoryStats() {
+  return this._call("getMemoryStats", []);
+}
+
+// The REPL is driven from this thread, so that it can prompt for input.
+PyPyJS.Worker.prototype.repl = PyPyJS.prototype.repl;
+PyPyJS.Worker.prototype._repl_loop = PyPyJS.prototype._repl_loop;
+PyPyJS.Worker.prototype.findImportedNames = PyPyJS.prototype.findImportedNames;
+
+// Abandon any running code, and replace the interpreter with a fresh one.
+// Returns a promise that resolves once the new interpreter is ready.
+PyPyJS.Worker.prototype.cancel = function cancel() {
+  this._stop(new PyPyJS.Error("Cancelled", "The interpreter was cancelled"));
+  this._start();
+  return this.ready;
+}
+
+// Stop the worker for good.
+PyPyJS.Worker.prototype.terminate = function terminate() {
+  this._stop(new PyPyJS.Error("Terminated", "The interpreter was terminated"));
+  this.ready = Promise.reject(new PyPyJS.Error("The interpreter was terminated"));
+  this.ready.then(null, function() {});
+}
+
+PyPyJS.Worker.prototype._start = function _start() {
+  var onMessage = this._onMessage.bind(this);
+  var onError = (function(err) {
+    this._rejectAll(new PyPyJS.Error("WorkerError", String(err && err.message || err)));
+  }).bind(this);
+  if (typeof Worker !== "undefined") {
+    // For the web, use a Web Worker.
+    this._worker = new Worker(this._workerURL);
+    this._worker.onmessage = function(evt) {
+      onMessage(evt.data);
+    };
+    this._worker.onerror = function(evt) {
+      onError(evt);
+    };
+  } else if (typeof require === "function") {
+    // For nodejs, use a worker thread.  It's left unreferenced while
+    // there are no calls in progress, so it won't keep the process alive.
+    var worker_threads = require("worker_threads");
+    this._worker = new worker_threads.Worker(this._workerURL);
+    this._worker.on("message", onMessage);
+    this._worker.on("error", onError);
+    this._worker.unref();
+  } else {
+    throw new PyPyJS.Error("workers are not available");
+  }
+  this.ready = this._post("init", [this._workerOpts]);
+}
+
+PyPyJS.Worker.prototype._stop = function _stop(err) {
+  if (this._worker) {
+    this._worker.terminate();
+    this._worker = null;
+  }
+  this._rejectAll(err);
+}
+
+PyPyJS.Worker.prototype._call = function _call(method, args) {
+  return this.ready.then((function() {
+    return this._post(method, args);
+  }).bind(this));
+}
+
+PyPyJS.Worker.prototype._post = function _post(method, args) {
+  if (!this._worker) {
+    return Promise.reject(new PyPyJS.Error("The interpreter was terminated"));
+  }
+  var id = this._nextCallID++;
+  var p = new Promise((function(resolve, reject) {
+    this._pendingCalls[id] = { resolve: resolve, reject: reject };
+  }).bind(this));
+  if (this._worker.ref) {
+    this._worker.ref();
+  }
+  this._worker.postMessage({ id: id, method: method, args: args });
+  return p;
+}
+
+PyPyJS.Worker.prototype._onMessage = function _onMessage(msg) {
+  if (msg.output) {
+    for (var i = 0; i < msg.output.length; i++) {
+      this[msg.output[i].stream](msg.output[i].data);
+    }
+    return;
+  }
+  var call = this._pendingCalls[msg.id];
+  if (!call) {
+    return;
+  }
+  delete this._pendingCalls[msg.id];
+  this._unrefIfIdle();
+  if (msg.error) {
+    call.reject(new PyPyJS.Error(msg.error.name, msg.error.message, msg.error.trace));
+  } else {
+    call.resolve(msg.result);
+  }
+}
+
+PyPyJS.Worker.prototype._rejectAll = function _rejectAll(err) {
+  var calls = this._pendingCalls;
+  this._pendingCalls = {};
+  this._unrefIfIdle();
+  for (var id in calls) {
+    calls[id].reject(err);
+  }
+}
+
+PyPyJS.Worker.prototype._unrefIfIdle = function _unrefIfIdle() {
+  if (this._worker && this._worker.unref) {
+    if (!Object.keys(this._pendingCalls).length) {
+      this._worker.unref();
+    }
+  }
+}
+
+
 // An error class for reporting python exceptions back to calling code.
 // XXX TODO: this could be a lot more user-friendly than a opaque error...
 
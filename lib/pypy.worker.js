@@ -0,0 +1,139 @@
+//
+//  PyPyJS worker:  host a PyPyJS interpreter off the main thread.
+//
+//  This script is loaded into a web worker or nodejs worker thread by
+//  PyPyJS.Worker, and runs calls to the interpreter on its behalf.
+//
+
+(function() {
+
+// Only these methods may be called from the other side.
+var METHODS = {
+  exec: true,
+  eval: true,
+  execfile: true,
+  get: true,
+  getMany: true,
+  setBuffer: true,
+  getBuffer: true,
+  set: true,
+  loadModuleData: true,
+  getMemoryStats: true,
+  _execute_source: true
+};
+
+// Output is sent back in batches rather than character-by-character.
+// A batch is sent when it gets big enough, when a call finishes, or once
+// the worker is idle, whichever comes first.
+var MAX_OUTPUT_BATCH = 4096;
+
+
+var PyPyJS, postMessage;
+if (typeof importScripts !== "undefined") {
+  // For the web, we're running in a Web Worker.
+  importScripts("FunctionPromise.js", "pypy.js");
+  PyPyJS = self.PyPyJS;
+  postMessage = function(msg, transfer) {
+    self.postMessage(msg, transfer || []);
+  };
+  self.onmessage = function(evt) {
+    onMessage(evt.data);
+  };
+} else {
+  // For nodejs, we're running in a worker thread.
+  var parentPort = require("worker_threads").parentPort;
+  PyPyJS = require("./pypy.js");
+  postMessage = function(msg, transfer) {
+    parentPort.postMessage(msg, transfer || []);
+  };
+  parentPort.on("message", onMessage);
+}
+
+
+var vm = null;
+var output = [];
+var outputSize = 0;
+var outputTimer = null;
+
+
+function writeOutput(stream, data) {
+  var last = output[output.length - 1];
+  if (last && last.stream === stream) {
+    last.data += data;
+  } else {
+    output.push({ stream: stream, data: data });
+  }
+  outputSize += data.length;
+  if (outputSize >= MAX_OUTPUT_BATCH) {
+    flushOutput();
+  } else if (outputTimer === null) {
+    outputTimer = setTimeout(flushOutput, 0);
+  }
+}
+
+
+function flushOutput() {
+  if (outputTimer !== null) {
+    clearTimeout(outputTimer);
+    outputTimer = null;
+  }
+  if (output.length) {
+    postMessage({ output: output });
+    output = [];
+    outputSize = 0;
+  }
+}
+
+
+function onMessage(msg) {
+  var p;
+  if (msg.method === "init") {
+    var opts = msg.args[0];
+    opts.stdout = function(data) {
+      writeOutput("stdout", data);
+    };
+    opts.stderr = function(data) {
+      writeOutput("stderr", data);
+    };
+    vm = new PyPyJS(opts);
+    p = vm.ready;
+  } else if (!METHODS[msg.method]) {
+    p = Promise.reject(new PyPyJS.Error("unknown method: " + msg.method));
+  } else {
+    // A view into the interpreter's memory would copy all of it,
+    // so just send a copy of the array's contents.
+    if (msg.method === "getBuffer") {
+      msg.args = [msg.args[0], { copy: true }];
+    }
+    p = Promise.resolve().then(function() {
+      return vm[msg.method].apply(vm, msg.args);
+    });
+  }
+  p.then(function(result) {
+    flushOutput();
+    try {
+      if (msg.method === "getBuffer") {
+        postMessage({ id: msg.id, result: result }, [result.buffer]);
+      } else {
+        postMessage({ id: msg.id, result: result });
+      }
+    } catch (err) {
+      // The result couldn't be copied back to the other side.
+      postMessage({ id: msg.id, error: describeError(err) });
+    }
+  }, function(err) {
+    flushOutput();
+    postMessage({ id: msg.id, error: describeError(err) });
+  });
+}
+
+
+function describeError(err) {
+  return {
+    name: err && err.name || "Error",
+    message: err && err.message || String(err),
+    trace: err && err.trace || ""
+  };
+}
+
+})();
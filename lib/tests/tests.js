@@ -100,6 +100,78 @@ var PyPyJSTestResult = vm.ready
   }
 })
 
+// Check that containers are sent back as JSON, without needing the
+// json module to be loaded.
+.then(function() {
+  return vm.exec("z = [1, 2.5, u'\\u20ac', {'a': None, 'b': True}]");
+})
+.then(function() {
+  var parse = JSON.parse;
+  var parsed = false;
+  JSON.parse = function() {
+    parsed = true;
+    return parse.apply(JSON, arguments);
+  };
+  return vm.get("z").then(function(z) {
+    JSON.parse = parse;
+    return z;
+  }, function(err) {
+    JSON.parse = parse;
+    throw err;
+  })
+  .then(function(z) {
+    if (!parsed) {
+      throw new Error("container wasn't sent back as JSON");
+    }
+    if (z.length !== 4 || z[0] !== 1 || z[1] !== 2.5 || z[2] !== "\u20ac" ||
+        z[3].a !== null || z[3].b !== true) {
+      throw new Error("container wasn't converted correctly");
+    }
+    return vm.eval("'json' in __import__('sys').modules");
+  });
+})
+.then(function(loaded) {
+  if (loaded) {
+    throw new Error("sending back a container loaded the json module");
+  }
+})
+
+// Check that VMs started from a snapshot work, and are independent.
+.then(function() {
+  return PyPyJS.createSnapshot();
+})
+.then(function(snapshot) {
+  var vm1 = snapshot.spawn();
+  var vm2 = snapshot.spawn();
+  return Promise.all([vm1.ready, vm2.ready])
+  .then(function() {
+    return vm1.exec("import json, os\nx = json.loads('[1, 2]')[1]");
+  })
+  .then(function() {
+    return vm1.exec("with open('/tmp/snap.txt', 'w') as f: f.write('ok')");
+  })
+  .then(function() {
+    return vm1.eval("x + len(open('/tmp/snap.txt').read())");
+  })
+  .then(function(x) {
+    if (x !== 4) {
+      throw new Error("VM from snapshot didn't run code correctly");
+    }
+    return vm2.get("x");
+  })
+  .then(function(x) {
+    if (typeof x !== "undefined") {
+      throw new Error("VMs from snapshot share state");
+    }
+    return vm2.eval("__import__('collections').Counter('aab')['a']");
+  })
+  .then(function(n) {
+    if (n !== 2) {
+      throw new Error("VM from snapshot couldn't import a module");
+    }
+  });
+})
+
 // Report success or failure at the end of the chain.
 .then(function(res) {
   log("TESTS PASSED!");
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""
+    Tests for the parts of lib/pypy.js that don't need a built VM
+
+    These run small scripts under nodejs, and are skipped if it isn't
+    installed.  The rest of the library is tested against a real VM by
+    lib/tests/tests.js.
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import textwrap
+import unittest
+
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib")
+
+
+def find_node():
+    for name in ("node", "nodejs"):
+        try:
+            subprocess.check_output([name, "--version"],
+                                    stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        return name
+    return None
+
+
+NODE = find_node()
+
+
+@unittest.skipIf(NODE is None, "needs nodejs")
+class NodeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_js(self, source):
+        """Run a script whose final expression is a promise for a result.
+
+        The script can use "PyPyJS", "FunctionPromise" and "tmpdir", and
+        the JSON-encoded result is returned.
+        """
+        script = textwrap.dedent("""\
+            var PyPyJS = require(%(lib)s + "/pypy.js");
+            var FunctionPromise = require(%(lib)s + "/FunctionPromise.js");
+            var tmpdir = %(tmpdir)s;
+            Promise.resolve().then(function() {
+            %(source)s
+            }).then(function(result) {
+              console.log(JSON.stringify(result));
+            }, function(err) {
+              console.error(err && err.stack || err);
+              process.exit(1);
+            });
+        """) % {
+            "lib": json.dumps(LIB_DIR),
+            "tmpdir": json.dumps(self.tmpdir),
+            "source": textwrap.dedent(source),
+        }
+        proc = subprocess.Popen([NODE, "-e", script], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            self.fail("script failed:\n%s" % stderr.decode("utf8"))
+        return json.loads(stdout.decode("utf8").strip().splitlines()[-1])
+
+
+class FunctionPromiseTestCase(NodeTestCase):
+
+    def test_function(self):
+        result = self.run_js("""
+            return FunctionPromise("a", "b", "return a + b").then(function(fn) {
+              return fn(2, 3);
+            });
+        """)
+        self.assertEqual(result, 5)
+
+    def test_function_body_parts(self):
+        result = self.run_js("""
+            var body = ["return '\\u00e9' + ", Buffer.from("'\\u20ac'", "utf8")];
+            return FunctionPromise(body).then(function(fn) {
+              return fn();
+            });
+        """)
+        self.assertEqual(result, u"\u00e9\u20ac")
+
+    def test_cache_file(self):
+        source = """
+            var fs = require("fs");
+            var cacheFile = tmpdir + "/fn.v8cache";
+            var opts = { cacheFile: cacheFile, filename: "fn.js" };
+            return FunctionPromise.withOptions(opts, "x", "return x * 2").then(function(fn) {
+              var result = fn(21);
+              return new Promise(function(resolve) {
+                setTimeout(resolve, 50);
+              }).then(function() {
+                return [result, fs.existsSync(cacheFile)];
+              });
+            });
+        """
+        self.assertEqual(self.run_js(source), [42, True])
+        cacheFile = os.path.join(self.tmpdir, "fn.v8cache")
+        self.assertTrue(os.path.getsize(cacheFile) > 0)
+        # Later processes compile the function using the cached data.
+        self.assertEqual(self.run_js(source), [42, True])
+        # A corrupt cache file is ignored.
+        with open(cacheFile, "wb") as f:
+            f.write(b"garbage")
+        self.assertEqual(self.run_js(source), [42, True])
+
+
+class CacheTestCase(NodeTestCase):
+
+    def test_string_size_is_utf8_length(self):
+        result = self.run_js("""
+            var cache = new PyPyJS.DirectoryCache(tmpdir + "/cache", { maxSize: 4 });
+            // Two characters, but six bytes once encoded.
+            return cache.put("big", "\\u20ac\\u20ac").then(function() {
+              return cache.put("small", "\\u00e9\\u00e9");
+            }).then(function() {
+              return Promise.all([cache.get("big"), cache.get("small")]);
+            });
+        """)
+        self.assertEqual(result, [None, u"\u00e9\u00e9"])
+
+    def test_eviction(self):
+        result = self.run_js("""
+            var cache = new PyPyJS.DirectoryCache(tmpdir + "/cache", { maxSize: 5 });
+            return cache.put("a", "aaa").then(function() {
+              return cache.put("b", "bbb");
+            }).then(function() {
+              return Promise.all([cache.get("a"), cache.get("b")]);
+            });
+        """)
+        self.assertEqual(result, [None, "bbb"])
+
+    def test_get_sync(self):
+        result = self.run_js("""
+            var cache = new PyPyJS.DirectoryCache(tmpdir + "/cache");
+            return cache.put("k", "data").then(function() {
+              return [cache.getSync("k"), cache.getSync("missing")];
+            });
+        """)
+        self.assertEqual(result, ["data", None])
+
+
+class PoolTestCase(NodeTestCase):
+
+    # The pool starts its interpreters from a snapshot if given one,
+    # which lets us give it fake interpreters that don't need a VM.
+    POOL = """
+        var snapshot = {
+          spawn: function() {
+            return {
+              ready: Promise.resolve(),
+              _execute_source: function() { return Promise.resolve(); }
+            };
+          }
+        };
+    """
+
+    def test_release_guards(self):
+        result = self.run_js(self.POOL + """
+            var pool = new PyPyJS.Pool({ size: 1, snapshot: snapshot });
+            var other = new PyPyJS.Pool({ size: 1, snapshot: snapshot });
+            var errors = [];
+            function tryRelease(p, vm) {
+              try {
+                return p.release(vm);
+              } catch (err) {
+                errors.push(err.message);
+              }
+            }
+            return Promise.all([pool.ready, other.ready]).then(function() {
+              return pool.acquire();
+            }).then(function(vm) {
+              tryRelease(other, vm);
+              tryRelease(pool, {});
+              var p = tryRelease(pool, vm);
+              tryRelease(pool, vm);
+              return p;
+            }).then(function() {
+              return errors;
+            });
+        """)
+        self.assertEqual(len(result), 3)
+        for message in result:
+            self.assertEqual(message,
+                             "interpreter was not acquired from this pool")
+
+    def test_wait_stats(self):
+        result = self.run_js(self.POOL + """
+            var pool = new PyPyJS.Pool({ size: 1, snapshot: snapshot });
+            return pool.ready.then(function() {
+              return pool.acquire();
+            }).then(function(vm1) {
+              var waiting = pool.acquire();
+              setTimeout(function() { pool.release(vm1); }, 20);
+              return waiting;
+            }).then(function(vm2) {
+              return pool.release(vm2);
+            }).then(function() {
+              return pool.getStats();
+            });
+        """)
+        self.assertEqual(result["acquired"], 2)
+        self.assertEqual(result["waited"], 1)
+        self.assertEqual(result["idle"], 1)
+        self.assertEqual(result["busy"], 0)
+        self.assertEqual(result["averageWaitTime"], result["maxWaitTime"])
+        self.assertTrue(result["averageWaitTime"] > 0)
+
+
+class GetManyTestCase(NodeTestCase):
+
+    def test_rejects_bad_names(self):
+        result = self.run_js("""
+            var vm = Object.create(PyPyJS.prototype);
+            function check(names) {
+              return vm.getMany(names).then(function() {
+                return null;
+              }, function(err) {
+                return [err.name, err.message];
+              });
+            }
+            return Promise.all([check("x"), check([1]), check({ length: 1 })]);
+        """)
+        self.assertEqual(result, [
+            ["TypeError", "names must be an array"],
+            ["TypeError", "names must be strings"],
+            ["TypeError", "names must be an array"],
+        ])
+
+
+class WorkerTestCase(NodeTestCase):
+
+    def test_auto_load_modules_option(self):
+        result = self.run_js("""
+            var workers = [
+              new PyPyJS.Worker(),
+              new PyPyJS.Worker({ autoLoadModules: false })
+            ];
+            var result = [];
+            workers.forEach(function(w) {
+              // There's no VM to start, so just stop the worker.
+              w.ready.then(null, function() {});
+              result.push(w.autoLoadModules);
+              w.terminate();
+            });
+            return result;
+        """)
+        self.assertEqual(result, [True, False])
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+    Tests for tools/module_bundler.py
+
+    The bundler is written for python 2, so these run it in a subprocess
+    with whichever python 2 interpreter can be found, and are skipped if
+    there isn't one.
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+
+BUNDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "..", "tools", "module_bundler.py")
+
+SOURCES = {
+    "app.py": """\
+        import mod
+        print(mod.f())
+        """,
+    "mod.py": '''\
+        """A module with a docstring."""
+
+        # A comment that minification should remove.
+        def f():
+            """Docstring of f."""
+            return 1
+        ''',
+    "introspect.py": '''\
+        def g():
+            """Docstring of g."""
+            return g.__doc__
+        ''',
+    "pkg/__init__.py": """\
+        from pkg import a
+        """,
+    "pkg/a.py": """\
+        import pkg.b
+        """,
+    "pkg/b.py": """\
+        import pkg.a
+        """,
+}
+
+
+def find_python2():
+    if sys.version_info[0] == 2:
+        return sys.executable
+    for name in ("python2", "python2.7"):
+        try:
+            subprocess.check_output(
+                [name, "-c", "import sys; assert sys.version_info[0] == 2"],
+                stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        return name
+    return None
+
+
+PYTHON2 = find_python2()
+
+
+@unittest.skipIf(PYTHON2 is None, "needs a python 2 interpreter")
+class ModuleBundlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, "src")
+        for relpath, source in SOURCES.items():
+            self.write_source(relpath, source)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_source(self, relpath, source):
+        filepath = os.path.join(self.srcdir, relpath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(textwrap.dedent(source))
+        return filepath
+
+    def src(self, relpath):
+        return os.path.join(self.srcdir, relpath)
+
+    def bundle(self, *args):
+        cmd = [PYTHON2, BUNDLER] + list(args)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0].decode("utf8")
+        if proc.returncode != 0:
+            self.fail("bundler failed: %s\n%s" % (" ".join(args), output))
+        return output
+
+    def bundle_sources(self, bundle_dir, *args):
+        return self.bundle("add", bundle_dir, self.src("app.py"),
+                           self.src("mod.py"), self.src("introspect.py"),
+                           self.src("pkg"), *args)
+
+    def read(self, bundle_dir, relpath):
+        with open(os.path.join(bundle_dir, relpath)) as f:
+            return f.read()
+
+    def read_json(self, bundle_dir, relpath):
+        return json.loads(self.read(bundle_dir, relpath))
+
+    def read_tree(self, dirpath):
+        files = {}
+        for root, dirnames, filenames in os.walk(dirpath):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                with open(filepath, "rb") as f:
+                    files[os.path.relpath(filepath, dirpath)] = f.read()
+        return files
+
+    def test_add(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle_sources(out)
+        modules = self.read_json(out, "index.json")["modules"]
+        self.assertEqual(modules["mod"]["file"], "mod.py")
+        self.assertEqual(modules["pkg"]["dir"], "pkg")
+        self.assertEqual(modules["app"]["imports"], ["mod"])
+        self.assertEqual(modules["pkg.__init__"]["imports"], ["pkg.a"])
+        self.assertEqual(modules["pkg.a"]["imports"], ["pkg.b"])
+        self.assertEqual(self.read(out, "mod.py"),
+                         textwrap.dedent(SOURCES["mod.py"]))
+
+    def test_jobs_gives_identical_bundle(self):
+        serial = os.path.join(self.tmpdir, "serial")
+        parallel = os.path.join(self.tmpdir, "parallel")
+        self.bundle_sources(serial)
+        self.bundle_sources(parallel, "--jobs", "4")
+        self.assertEqual(self.read_tree(serial), self.read_tree(parallel))
+
+    def test_incremental_rebuild(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle_sources(out)
+        # Unchanged files are not copied again.
+        old_mtime = int(time.time()) - 1000
+        os.utime(os.path.join(out, "mod.py"), (old_mtime, old_mtime))
+        self.bundle_sources(out)
+        self.assertEqual(os.stat(os.path.join(out, "mod.py")).st_mtime,
+                         old_mtime)
+        # Changed files are copied, and their imports re-scanned.
+        self.write_source("pkg/b.py", """\
+            import pkg.a
+            import mod
+            """)
+        self.bundle_sources(out)
+        self.assertIn("import mod", self.read(out, "pkg/b.py"))
+        modules = self.read_json(out, "index.json")["modules"]
+        self.assertIn("mod", modules["pkg.b"]["imports"])
+
+    def test_hash_names_removes_stale_files(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle_sources(out, "--hash-names")
+        old_url = self.read_json(out, "index.json")["modules"]["mod"]["url"]
+        self.assertTrue(old_url.startswith("hashed/"))
+        self.assertEqual(self.read(out, old_url), self.read(out, "mod.py"))
+        self.write_source("mod.py", "x = 2\n")
+        self.bundle_sources(out)
+        new_url = self.read_json(out, "index.json")["modules"]["mod"]["url"]
+        self.assertNotEqual(old_url, new_url)
+        self.assertEqual(self.read(out, new_url), "x = 2\n")
+        self.assertFalse(os.path.exists(os.path.join(out, old_url)))
+
+    def test_hash_names_of_identical_files(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.write_source("p1/__init__.py", "")
+        self.write_source("p2/__init__.py", "")
+        self.bundle("add", out, self.src("p1"), self.src("p2"), "--hash-names")
+        modules = self.read_json(out, "index.json")["modules"]
+        self.assertEqual(modules["p1.__init__"]["url"],
+                         modules["p2.__init__"]["url"])
+        # Changing one of them must leave the other's copy intact.
+        self.write_source("p1/__init__.py", "CHANGED = 1\n")
+        self.bundle("add", out, self.src("p1"), self.src("p2"))
+        modules = self.read_json(out, "index.json")["modules"]
+        self.assertEqual(self.read(out, modules["p1.__init__"]["url"]),
+                         "CHANGED = 1\n")
+        self.assertEqual(self.read(out, modules["p2.__init__"]["url"]), "")
+
+    def test_pack_import_cycles(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle_sources(out)
+        self.bundle("pack", "--scc", out)
+        packs = self.read_json(out, "index.json")["packs"]
+        self.assertEqual(list(packs), ["cycle-pkg"])
+        self.assertEqual(packs["cycle-pkg"]["modules"],
+                         ["pkg.__init__", "pkg.a", "pkg.b"])
+        contents = self.read_json(out, packs["cycle-pkg"]["file"])
+        self.assertEqual(contents["modules"]["pkg.b"], self.read(out, "pkg/b.py"))
+        # Clearing the packs removes their files.
+        self.bundle("pack", "--clear", out, "mod")
+        self.assertNotIn("packs", self.read_json(out, "index.json"))
+        self.assertEqual(os.listdir(os.path.join(out, "packs")), [])
+
+    def test_split_index(self):
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle_sources(out, "--split-index")
+        index = self.read_json(out, "index.json")
+        names = index["names"]
+        toplevel = set(names[int(i)] for i in index["modules"])
+        self.assertEqual(toplevel, set(["app", "mod", "introspect"]))
+        shard = self.read_json(out, index["shards"]["pkg"]["file"])
+        self.assertEqual(set(names[int(i)] for i in shard["modules"]),
+                         set(["pkg", "pkg.__init__", "pkg.a", "pkg.b"]))
+        app = index["modules"][str(names.index("app"))]
+        self.assertEqual(app["imports"], [names.index("mod")])
+        self.assertTrue(os.path.exists(
+            os.path.join(out, index["preload_pack"]["file"])))
+
+    def test_minify(self):
+        out = os.path.join(self.tmpdir, "out")
+        output = self.bundle_sources(out, "--minify")
+        self.assertIn("bytes saved", output)
+        minified = self.read(out, "mod.py")
+        compile(minified, "mod.py", "exec")
+        self.assertEqual(len(minified.splitlines()),
+                         len(textwrap.dedent(SOURCES["mod.py"]).splitlines()))
+        self.assertNotIn("comment", minified)
+        self.assertNotIn("docstring", minified)
+        # Modules that read docstrings keep them.
+        self.assertIn("Docstring of g.", self.read(out, "introspect.py"))
+        # The source is minified again if the settings change.
+        self.bundle_sources(out, "--minify-keep-docstrings")
+        minified = self.read(out, "mod.py")
+        self.assertIn("Docstring of f.", minified)
+        self.assertNotIn("comment", minified)
+
+    def test_build(self):
+        full = os.path.join(self.tmpdir, "full")
+        self.bundle_sources(full, "--minify", "--exclude", "unwanted")
+        out = os.path.join(self.tmpdir, "out")
+        self.bundle("build", out, "--from", full,
+                    "--entry", self.src("app.py"), "--allow", "pkg.a")
+        modules = self.read_json(out, "index.json")["modules"]
+        self.assertEqual(sorted(modules),
+                         ["app", "mod", "pkg", "pkg.__init__", "pkg.a", "pkg.b"])
+        self.assertEqual(self.read(out, "mod.py"), self.read(full, "mod.py"))
+        meta = self.read_json(out, "meta.json")
+        self.assertEqual(meta["exclude"],
+                         self.read_json(full, "meta.json")["exclude"])
+        self.assertIn("unwanted", meta["exclude"])
+        self.assertTrue(meta["minify"])
+
+    @unittest.skipIf("__pypy__" in sys.builtin_module_names,
+                     "bytecode can be compiled under pypy")
+    def test_bytecode_needs_pypy(self):
+        out = os.path.join(self.tmpdir, "out")
+        cmd = [PYTHON2, BUNDLER, "add", out, self.src("mod.py"),
+               "--bytecode-magic", "03f30d0a"]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0].decode("utf8")
+        self.assertNotEqual(proc.returncode, 0)
+        self.assertIn("bytecode must be compiled", output)
@@ -7,10 +7,12 @@
 #  to use a virtualized build environment, and gives us more fine-grained
 #  control over the loading of the memory data.
 #
-#  In a future iteration of this script, we will provide calling code with
-#  the opportunity to control loading of the memory initializer rather than
-#  have the compiled code load it automatically.  This could be helpful for
-#  e.g. downloading the initializer concurrently with compiling the script.
+#  Calling code can control loading of the memory initializer by providing
+#  its contents as an ArrayBuffer in Module["memoryInitializerData"], which
+#  lets it download the initializer concurrently with compiling the script.
+#  The compiled code will then skip loading the initializer itself, and the
+#  calling code must copy the data into memory at STATIC_BASE before
+#  running the program.
 #
 
 import os
@@ -50,7 +52,7 @@ try:
         raise ValueError("non-null memoryInitializer variable found")
 
     OUTPUT_FILEOBJ.write(data[:match.end()])
-    OUTPUT_FILEOBJ.write('"')
+    OUTPUT_FILEOBJ.write('Module["memoryInitializerData"] ? null : "')
     OUTPUT_FILEOBJ.write(os.path.basename(MEMORY_FILE))
     OUTPUT_FILEOBJ.write('"')
     
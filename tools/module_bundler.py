@@ -22,10 +22,19 @@ import os
 import re
 import sys
 import ast
+import imp
 import json
+import struct
+import base64
+import binascii
+import marshal
 import codecs
 import argparse
 import shutil
+import hashlib
+import tokenize
+import multiprocessing
+from cStringIO import StringIO
 
 
 def _u(path):
@@ -150,10 +159,8 @@ EXCLUDE_MODULES = [
     "curses",
 ]
 
-# Modules that are pretty much always needed, and so should be loaded eagerly.
-PRELOAD_MODULES = [
-    "os",
-    "code",
+# Modules that are needed to start up the VM, and so must always be preloaded.
+STARTUP_MODULES = [
     "traceback",
     # Python has some magic to auto-load encodings when they're needed,
     # which doesn't work right if they're not preloaded.
@@ -169,6 +176,25 @@ PRELOAD_MODULES = [
     "encodings.raw_unicode_escape",
 ]
 
+# Modules that are pretty much always needed, and so should be loaded eagerly.
+PRELOAD_MODULES = [
+    "os",
+    "code",
+] + STARTUP_MODULES
+
+# Names whose appearance in a file means it may read docstrings, and so
+# should keep its own when minified.  This can't see code that reads the
+# docstrings of other modules, which needs --minify-keep-docstrings.
+DOCSTRING_READERS = [
+    "__doc__",
+    "pydoc",
+    "inspect",
+    "doctest",
+]
+
+# Default size budget for a preload set generated from module traces.
+DEFAULT_PRELOAD_BUDGET = 400 * 1024
+
 
 def main(argv):
     parser = argparse.ArgumentParser()
@@ -184,6 +210,22 @@ def main(argv):
                              help="preload these modules in the bundle")
     parser_init.add_argument("--pypy-root", action="store",
                              help="root directory of pypy source checkout")
+    parser_init.add_argument("--jobs", "-j", action="store", type=int,
+                             default=1,
+                             help="number of processes for import analysis")
+    parser_init.add_argument("--bytecode", action="store_true", default=False,
+                             help="also compile modules to .pyc files in the bundle")
+    parser_init.add_argument("--bytecode-magic", action="store",
+                             help="hex magic number of the target VM's .pyc files")
+    parser_init.add_argument("--hash-names", action="store_true", default=False,
+                             help="also write files under content-addressed names")
+    parser_init.add_argument("--split-index", action="store_true", default=False,
+                             help="write a compact index split into lazily-loaded shards")
+    parser_init.add_argument("--minify", action="store_true", default=False,
+                             help="strip comments and docstrings from bundled source files")
+    parser_init.add_argument("--minify-keep-docstrings", action="store_true",
+                             default=False,
+                             help="like --minify, but keep all docstrings")
 
     parser_add = subparsers.add_parser("add")
     parser_add.add_argument("bundle_dir")
@@ -194,11 +236,54 @@ def main(argv):
                             help="preload these modules in the bundle")
     parser_add.add_argument("--include", action="append",
                             help="include these modules in the bundle, overrides exclude")
+    parser_add.add_argument("--jobs", "-j", action="store", type=int,
+                            default=1,
+                            help="number of processes for import analysis")
+    parser_add.add_argument("--bytecode", action="store_true", default=False,
+                            help="also compile modules to .pyc files in the bundle")
+    parser_add.add_argument("--bytecode-magic", action="store",
+                            help="hex magic number of the target VM's .pyc files")
+    parser_add.add_argument("--hash-names", action="store_true", default=False,
+                            help="also write files under content-addressed names")
+    parser_add.add_argument("--split-index", action="store_true", default=False,
+                            help="write a compact index split into lazily-loaded shards")
+    parser_add.add_argument("--minify", action="store_true", default=False,
+                            help="strip comments and docstrings from bundled source files")
+    parser_add.add_argument("--minify-keep-docstrings", action="store_true",
+                            default=False,
+                            help="like --minify, but keep all docstrings")
+
+    parser_build = subparsers.add_parser("build")
+    parser_build.add_argument("bundle_dir")
+    parser_build.add_argument("--entry", action="append", required=True,
+                              help="bundle this file and everything it imports")
+    parser_build.add_argument("--from", action="store", required=True,
+                              dest="source_dir",
+                              help="existing bundle to take imported modules from")
+    parser_build.add_argument("--allow", action="append",
+                              help="also include these modules, e.g. for dynamic imports")
 
     parser_preload = subparsers.add_parser("preload")
     parser_preload.add_argument("bundle_dir")
     parser_preload.add_argument("modules", nargs="+", metavar="module")
     
+    parser_trace = subparsers.add_parser("preload-trace")
+    parser_trace.add_argument("bundle_dir")
+    parser_trace.add_argument("traces", nargs="+", metavar="trace",
+                              help="module trace files recorded by PyPyJS")
+    parser_trace.add_argument("--budget", action="store", type=int,
+                              default=DEFAULT_PRELOAD_BUDGET,
+                              help="maximum size of preloaded files, in bytes")
+
+    parser_pack = subparsers.add_parser("pack")
+    parser_pack.add_argument("bundle_dir")
+    parser_pack.add_argument("modules", nargs="*", metavar="module",
+                             help="pack the dependencies of these modules")
+    parser_pack.add_argument("--scc", action="store_true", default=False,
+                             help="pack each group of mutually-importing modules")
+    parser_pack.add_argument("--clear", action="store_true", default=False,
+                             help="remove all existing packs first")
+
     parser_remove = subparsers.add_parser("remove")
     parser_remove.add_argument("bundle_dir")
     parser_remove.add_argument("modules", nargs="+", metavar="module")
@@ -206,30 +291,51 @@ def main(argv):
                                help="delete the modules out of the bundle_dir, instead of just de-listing them")
     
     opts = parser.parse_args(argv[1:])
-    bundler = ModuleBundle(_u(opts.bundle_dir))
-    if opts.subcommand == "init":
-        cmd_init(bundler, opts)
-    elif opts.subcommand == "add":
-        cmd_add(bundler, opts)
-    elif opts.subcommand == "preload":
-        cmd_preload(bundler, opts)
-    elif opts.subcommand == "remove":
-        cmd_remove(bundler, opts)
-    else:
-        assert False, "unknown subcommand {}".format(opts.subcommand)
+    bundler = ModuleBundle(_u(opts.bundle_dir),
+                           jobs=getattr(opts, "jobs", 1))
+    try:
+        if opts.subcommand == "init":
+            cmd_init(bundler, opts)
+        elif opts.subcommand == "add":
+            cmd_add(bundler, opts)
+        elif opts.subcommand == "build":
+            cmd_build(bundler, opts)
+        elif opts.subcommand == "preload":
+            cmd_preload(bundler, opts)
+        elif opts.subcommand == "preload-trace":
+            cmd_preload_trace(bundler, opts)
+        elif opts.subcommand == "pack":
+            cmd_pack(bundler, opts)
+        elif opts.subcommand == "remove":
+            cmd_remove(bundler, opts)
+        else:
+            assert False, "unknown subcommand {}".format(opts.subcommand)
+    finally:
+        bundler.close()
     return 0
 
 
 def cmd_init(bundler, opts):
+    # Enable bytecode compilation if requested.
+    if opts.bytecode or opts.bytecode_magic:
+        bundler.enable_bytecode(opts.bytecode_magic)
+    if opts.hash_names:
+        bundler.hash_names = True
+    if opts.split_index:
+        bundler.split_index = True
+    if opts.minify or opts.minify_keep_docstrings:
+        bundler.minify = True
+    if opts.minify_keep_docstrings:
+        bundler.minify_docstrings = False
     # Update the bundler's exclusion list.
     if opts.exclude:
         for name in opts.exclude:
             if not bundler.is_excluded(name):
-                bundler.exclude.append(name)
+                bundler.exclude_module(name)
     if opts.include:
         for name in opts.include:
             if bundler.is_excluded(name):
-                bundler.exclude.remove(name)
+                bundler.include_module(name)
     # Walk the pypy stdlib dirs to find all available module files and
     # copy them into the bundle.
     if opts.pypy_root:
@@ -247,18 +353,30 @@ def cmd_init(bundler, opts):
         for name in opts.preload:
             bundler.preload_module(name)
     bundler.flush_index()
+    report_minified_sizes(bundler)
 
 
 def cmd_add(bundler, opts):
+    # Enable bytecode compilation if requested.
+    if opts.bytecode or opts.bytecode_magic:
+        bundler.enable_bytecode(opts.bytecode_magic)
+    if opts.hash_names:
+        bundler.hash_names = True
+    if opts.split_index:
+        bundler.split_index = True
+    if opts.minify or opts.minify_keep_docstrings:
+        bundler.minify = True
+    if opts.minify_keep_docstrings:
+        bundler.minify_docstrings = False
     # Update the exclude list if necessary.
     if opts.exclude:
         for name in opts.exclude:
             if not bundler.is_excluded(name):
-                bundler.exclude.append(name)
+                bundler.exclude_module(name)
     if opts.include:
         for name in opts.include:
             if bundler.is_excluded(name):
-                bundler.exclude.remove(name)
+                bundler.include_module(name)
     # Find and bundle each module/package.
     for name in opts.modules:
         if os.path.exists(name):
@@ -271,6 +389,58 @@ def cmd_add(bundler, opts):
         for name in opts.preload:
             bundler.preload_module(name)
     bundler.flush_index()
+    report_minified_sizes(bundler)
+
+
+def cmd_build(bundler, opts):
+    if bundler.modules:
+        raise ValueError("bundle dir is not empty: {}".format(opts.bundle_dir))
+    source_dir = _u(opts.source_dir)
+    if not os.path.exists(os.path.join(source_dir, "index.json")):
+        raise ValueError("not a module bundle: {}".format(opts.source_dir))
+    source = ModuleBundle(source_dir)
+    # Build the new bundle in the same way as the one we're taking from.
+    for name in list(bundler.exclude):
+        if name not in source.exclude:
+            bundler.include_module(name)
+    for name in source.exclude:
+        if name not in bundler.exclude:
+            bundler.exclude_module(name)
+    if source.bytecode_magic is not None:
+        bundler.enable_bytecode(source.bytecode_magic)
+    bundler.hash_names = source.hash_names
+    bundler.split_index = source.split_index
+    bundler.minify = source.minify
+    bundler.minify_docstrings = source.minify_docstrings
+    # Bundle the application files, leaving their imports as missing.
+    for filename in opts.entry:
+        if not os.path.exists(filename):
+            raise ValueError("non-existent module: {}".format(filename))
+        bundler.bundle_path(filename)
+    # Copy across everything they need, along with anything that was
+    # explicitly allowed and anything needed to start up the VM.
+    required = set()
+    roots = list(bundler.missing) + list(source.preload) + (opts.allow or [])
+    for name in roots:
+        while name not in source.modules and "." in name:
+            name = name.rsplit(".", 1)[0]
+        if name in source.modules and name not in bundler.modules:
+            required.update(source._find_transitive_dependencies(name))
+    # Deeper names go first, so that they're not resolved to their parent.
+    for name in sorted(required, reverse=True):
+        bundler.copy_module(source, name)
+    for name in sorted(required):
+        for depname in bundler.modules[name].get("imports", ()):
+            if depname not in bundler.modules:
+                if not bundler.is_excluded(depname):
+                    if not bundler.is_builtin(depname):
+                        bundler._add_missing(depname, name)
+    for packname, packdata in source.packs.iteritems():
+        bundler._add_pack(packname, packdata["modules"])
+    for name in source.preload:
+        if name in bundler.modules:
+            bundler.preload_module(name)
+    bundler.flush_index()
 
 
 def cmd_preload(bundler, opts):
@@ -278,6 +448,26 @@ def cmd_preload(bundler, opts):
         bundler.preload_module(name)
     bundler.flush_index()
 
+
+def cmd_preload_trace(bundler, opts):
+    traces = []
+    for filename in opts.traces:
+        with open(filename) as f:
+            traces.append(json.load(f)["modules"])
+    bundler.preload_from_traces(traces, opts.budget)
+    bundler.flush_index()
+
+
+def cmd_pack(bundler, opts):
+    if opts.clear:
+        bundler.packs.clear()
+    for name in opts.modules:
+        bundler.pack_module(name)
+    if opts.scc or not opts.modules:
+        bundler.pack_cycles()
+    bundler.flush_index()
+
+
 def cmd_remove(bundler, opts):
     for name in opts.modules:
         for module in bundler.modules.copy():
@@ -286,6 +476,9 @@ def cmd_remove(bundler, opts):
                     file_name = bundler.modules[module].get("file", None)
                     if file_name and os.path.exists(os.path.join(bundler.bundle_dir, file_name)):
                         os.remove(os.path.join(bundler.bundle_dir, file_name))
+                    pyc_name = bundler.modules[module].get("pyc", None)
+                    if pyc_name and os.path.exists(os.path.join(bundler.bundle_dir, pyc_name)):
+                        os.remove(os.path.join(bundler.bundle_dir, pyc_name))
                     dir_name = bundler.modules[module].get("dir", None)
                     if dir_name and os.path.exists(os.path.join(bundler.bundle_dir, dir_name)):
                         shutil.rmtree(os.path.join(bundler.bundle_dir, dir_name))
@@ -293,8 +486,21 @@ def cmd_remove(bundler, opts):
         for module in bundler.preload.copy():
             if re.match(name, module):
                 bundler.preload.pop(module)
+                bundler.preload_bytecode.pop(module, None)
     bundler.flush_index()
 
+def report_minified_sizes(bundler):
+    if not bundler.minified_sizes:
+        return
+    total_saved = 0
+    for relpath, (size, minified_size) in sorted(bundler.minified_sizes.items()):
+        saved = size - minified_size
+        total_saved += saved
+        print "{}: {} bytes saved ({} -> {})".format(relpath, saved, size,
+                                                    minified_size)
+    print "Total: {} bytes saved in {} files".format(
+        total_saved, len(bundler.minified_sizes))
+
 class ModuleBundle(object):
     """Class managing a directory of bundled modules.
 
@@ -312,13 +518,90 @@ class ModuleBundle(object):
             "file": "<a.py>"   # for modules, relative path to .py file
             "dir": "<A>"       # for packages, relative path to package dir
             "imports": []      # list of module names imported by this module
+            "pyc": "<a.pyc>"   # optional, relative path to compiled .pyc file
+            "mtime": 0         # optional, source mtime recorded in the .pyc
+            "url": "<h.py>"    # optional, content-addressed copy of "file"
+            "pyc_url": "<h.pyc>"   # optional, content-addressed copy of "pyc"
+          }
+        },
+        "files": {           # optional, maps support files from the parent
+          "pypy.vm.js": "<h.js>",       # dir to content-addressed copies
+          "pypy.vm.js.mem": "<h.mem>"
+        },
+        "packs": {           # optional, maps pack name to metadata
+          "p": {
+            "file": "<packs/p.json>"   # relative path to the pack file
+            "url": "<h.json>"          # optional, content-addressed copy
+            "modules": []              # list of module names in the pack
           }
         },
         "preload": {         # maps dotted module name to raw file contents
           "x.y": "<code>",
         }
+        "preload_bytecode": {   # optional, maps dotted module name to
+          "x.y": "<base64>",    # base64-encoded contents of its .pyc file
+        }
+      }
+
+    The .pyc files are only generated if bytecode compilation is enabled
+    for the bundle.  They let the VM skip parsing and compiling a module when
+    it is imported, but only if the .py file is given the recorded "mtime"
+    when it's written into the VM's filesystem.
+
+    A pack is a single file containing the contents of several modules that
+    are likely to be loaded together, such as the dependencies of a large
+    package or a group of modules that import each other.  This lets them
+    be fetched in a single request.  Pack files are JSON, in the same format
+    as the "preload" and "preload_bytecode" fields of the index:
+
+      {
+        "modules": {"x.y": "<code>"},
+        "bytecode": {"x.y": "<base64>"},
+      }
+
+    If content-addressed names are enabled for the bundle, a copy of each
+    file is also written into the "hashed" subdirectory under a name derived
+    from a hash of its contents, and the "url" fields give the path to load
+    it from.  Since the contents at such a path will never change, they can
+    be served with very aggressive HTTP caching headers.  The same is done
+    for the VM's code and memory initializer files, if they're found in the
+    parent directory of the bundle.
+
+    The index can optionally be written in a split format, which is faster
+    to load on a slow connection.  The module graph is written compactly,
+    with each module name stored only once and referred to elsewhere by its
+    position in the list of names.  Only the entries for top-level modules
+    and preloaded modules are kept in the index itself; the entries for the
+    rest of each top-level package are written to a separate shard file, to
+    be fetched the first time a module from that package is needed.  The
+    preloaded file data moves out into a file of its own, in the same format
+    as a pack file, so the loader can fetch it while it processes the rest
+    of the index.  The structure of a split index.json is as follows:
+
+      {
+        "names": ["a", "a.b"],   # list of all module names
+        "modules": {             # maps position of module name to metadata,
+          "0": {                 # as above except that "imports" is a list
+            "imports": [1]       # of name positions rather than names
+          }
+        },
+        "shards": {              # maps top-level package name to metadata
+          "a": {
+            "file": "<shards/a.json>"   # relative path to the shard file
+            "url": "<h.json>"           # optional, content-addressed copy
+          }
+        },
+        "preload_pack": {        # metadata for the file of preloaded modules
+          "file": "<preload.json>"
+          "url": "<h.json>"      # optional, content-addressed copy
+        },
+        "files": {},             # as above
+        "packs": {}              # as above, with "modules" as name positions
       }
 
+    Each shard file holds a "modules" field in the same compact format as
+    that of the split index.
+
     There is also an ancilliary file "meta.json" which tracks information
     useful when building up the bundle, not unnecessary when loading modules
     from it.  This helps avoid paying the overhead of loading the extra
@@ -330,36 +613,107 @@ class ModuleBundle(object):
         "exclude": [      # list of modules excluded from the bundle
           "some.module"
         ]
+        "bytecode_magic": "<hex>"   # magic number for compiled .pyc files,
+                                    # or null if they are not generated
+        "hash_names": false         # whether to write content-addressed
+                                    # copies of each file
+        "split_index": false        # whether to write the index in the
+                                    # split format
+        "minify": false             # whether to strip comments and
+                                    # docstrings from bundled files
+        "minify_docstrings": true   # whether minifying also strips
+                                    # docstrings
         "missing": {      # maps dotted module names that are not found in the
           "a.b.c.d": []   # bundle to the modules that would import them.
         }
+        "sources": {      # maps relative path of each bundled file to info
+          "a/b.py": {     # about the source file it was copied from.
+            "path": "<src>"          # absolute path of the source file
+            "mtime": 0.0             # mtime of the source file
+            "size": 0                # size of the source file
+            "hash": "<sha1>"         # sha1 hash of the source file contents
+            "scanned_imports": []    # raw names found by ImportScanner
+            "minified": false        # whether the bundled file was minified
+          }
+        }
       }
 
+    The "sources" information lets us rebuild a bundle incrementally.  Files
+    whose source is unchanged since it was last bundled are not copied again,
+    and the results of parsing them for imports are re-used rather than
+    parsing them from scratch.
+
+    Import analysis can optionally be spread across several worker processes
+    by passing jobs > 1.  The workers only do the expensive parsing of each
+    file; resolving the imported names against the bundle happens back in
+    the main process, in the same order as a serial run, so the resulting
+    bundle is identical either way.
     """
 
-    def __init__(self, bundle_dir):
+    def __init__(self, bundle_dir, jobs=1):
         self.bundle_dir = os.path.abspath(bundle_dir)
         self.index_file = os.path.join(self.bundle_dir, "index.json")
         self.meta_file = os.path.join(self.bundle_dir, "meta.json")
         self.modules = {}
         self.preload = {}
+        self.preload_bytecode = {}
+        self.files = {}
+        self.packs = {}
+        self.bytecode_magic = None
+        self.hash_names = False
+        self.split_index = False
+        self.minify = False
+        self.minify_docstrings = True
+        self.minified_sizes = {}
         self.exclude = list(EXCLUDE_MODULES)
         self.missing = {}
+        self._builtin_set = set(BUILTIN_MODULES)
+        self._exclude_set = set(self.exclude)
+        self._missing_index = {}
+        self.sources = {}
         self._modules_pending_import_analysis = []
+        self.jobs = jobs
+        self._pool = None
+        self._import_scans = {}
+        self._module_srcpaths = {}
         if not os.path.isdir(self.bundle_dir):
             os.makedirs(self.bundle_dir)
         if not os.path.exists(self.index_file):
             self.flush_index()
         self.load_index()
 
+    def close(self):
+        """Shut down any worker processes used for import analysis."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._import_scans.clear()
+
     def flush_index(self):
         """Write out the index file based on in-memory state."""
+        self._write_pack_files()
+        if self.hash_names:
+            self._write_hashed_files()
         # Atomically update the index file.
-        with open(self.index_file + ".new", "w") as f:
-            json.dump({
+        if self.split_index:
+            index = self._write_split_index_files()
+        else:
+            index = {
                 "modules": self.modules,
                 "preload": self.preload,
-            }, f, indent=2, sort_keys=True)
+            }
+            if self.preload_bytecode:
+                index["preload_bytecode"] = self.preload_bytecode
+            if self.files:
+                index["files"] = self.files
+            if self.packs:
+                index["packs"] = self.packs
+        with open(self.index_file + ".new", "w") as f:
+            if self.split_index:
+                json.dump(index, f, sort_keys=True, separators=(",", ":"))
+            else:
+                json.dump(index, f, indent=2, sort_keys=True)
         if sys.platform.startswith("win32"):
             shutil.copy(self.index_file + ".new", self.index_file)
             os.remove(self.index_file + ".new")
@@ -368,8 +722,14 @@ class ModuleBundle(object):
         # Atomically update the meta file.
         with open(self.meta_file + ".new", "w") as f:
             json.dump({
+                "bytecode_magic": self.bytecode_magic,
                 "exclude": self.exclude,
+                "hash_names": self.hash_names,
+                "minify": self.minify,
+                "minify_docstrings": self.minify_docstrings,
                 "missing": self.missing,
+                "sources": self.sources,
+                "split_index": self.split_index,
             }, f, indent=2, sort_keys=True)
         if sys.platform.startswith("win32"):
             shutil.copy(self.meta_file + ".new", self.meta_file)
@@ -384,17 +744,248 @@ class ModuleBundle(object):
                 filepath = os.path.join(self.bundle_dir, moddata["file"])
                 if os.path.exists(filepath):
                     os.unlink(filepath)
+            if name in self.preload_bytecode:
+                filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                if os.path.exists(filepath):
+                    os.unlink(filepath)
+
+    def _write_hashed_files(self):
+        """Write content-addressed copies of all files in the bundle.
+
+        These are real copies rather than links, since the bundle files
+        they're taken from get rewritten in place.  Any old copies that are
+        no longer referenced are removed.
+        """
+        hashed_dir = os.path.join(self.bundle_dir, "hashed")
+        if not os.path.isdir(hashed_dir):
+            os.makedirs(hashed_dir)
+        referenced = set()
+        for name, moddata in self.modules.iteritems():
+            moddata.pop("url", None)
+            moddata.pop("pyc_url", None)
+            # Preloaded modules will never be loaded from a separate file.
+            if name in self.preload:
+                continue
+            if "file" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["file"])
+                moddata["url"] = self._copy_hashed_file(filepath)
+                referenced.add(moddata["url"])
+            if "pyc" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                moddata["pyc_url"] = self._copy_hashed_file(filepath)
+                referenced.add(moddata["pyc_url"])
+        for packdata in self.packs.itervalues():
+            filepath = os.path.join(self.bundle_dir, packdata["file"])
+            packdata["url"] = self._copy_hashed_file(filepath)
+            referenced.add(packdata["url"])
+        # Include the VM code and memory initializer, if they sit
+        # alongside the bundle.
+        for filename in ("pypy.vm.js", "pypy.vm.js.mem"):
+            self.files.pop(filename, None)
+            filepath = os.path.join(os.path.dirname(self.bundle_dir), filename)
+            if os.path.exists(filepath):
+                self.files[filename] = self._copy_hashed_file(filepath)
+                referenced.add(self.files[filename])
+        for nm in os.listdir(hashed_dir):
+            if "hashed/" + nm not in referenced:
+                os.unlink(os.path.join(hashed_dir, nm))
+
+    def _copy_hashed_file(self, filepath):
+        """Copy a file into the bundle under a content-addressed name.
+
+        An existing copy is only re-used if its contents still match its
+        name, so that one damaged by an older version of this script gets
+        repaired.  This returns the path of the copy, relative to the bundle
+        dir.
+        """
+        digest = _file_digest(filepath)
+        ext = os.path.splitext(filepath)[1]
+        relpath = "hashed/" + digest + ext
+        hashpath = os.path.join(self.bundle_dir, relpath)
+        if not os.path.exists(hashpath) or _file_digest(hashpath) != digest:
+            # Write it under a temporary name then move it into place, to
+            # replace rather than overwrite any file linked to the old copy.
+            shutil.copyfile(filepath, hashpath + ".new")
+            if sys.platform.startswith("win32"):
+                shutil.copy(hashpath + ".new", hashpath)
+                os.remove(hashpath + ".new")
+            else:
+                os.rename(hashpath + ".new", hashpath)
+        return relpath
+
+    def _write_pack_files(self):
+        """Write out the file for each pack, based on the bundled files.
+
+        Modules that have since been removed from the bundle or preloaded
+        are dropped from the pack, and any old pack files are removed.
+        """
+        packs_dir = os.path.join(self.bundle_dir, "packs")
+        for packname, packdata in self.packs.items():
+            packed = {"modules": {}, "bytecode": {}}
+            modules = []
+            for name in packdata["modules"]:
+                moddata = self.modules.get(name)
+                if moddata is None or name in self.preload:
+                    continue
+                if "file" not in moddata:
+                    continue
+                modules.append(name)
+                filepath = os.path.join(self.bundle_dir, moddata["file"])
+                with open(filepath, "r") as f:
+                    packed["modules"][name] = f.read()
+                if "pyc" in moddata:
+                    filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                    with open(filepath, "rb") as f:
+                        packed["bytecode"][name] = base64.b64encode(f.read())
+            if not modules:
+                del self.packs[packname]
+                continue
+            packdata["modules"] = modules
+            if not os.path.isdir(packs_dir):
+                os.makedirs(packs_dir)
+            with open(os.path.join(self.bundle_dir, packdata["file"]), "w") as f:
+                json.dump(packed, f, sort_keys=True, separators=(",", ":"))
+        if os.path.isdir(packs_dir):
+            packfiles = set(p["file"] for p in self.packs.itervalues())
+            for nm in os.listdir(packs_dir):
+                if "packs/" + nm not in packfiles:
+                    os.unlink(os.path.join(packs_dir, nm))
+
+    def _write_split_index_files(self):
+        """Write out the shard and preload files for a split index.
+
+        This returns the contents of the split index file itself.  Any old
+        shard files that are no longer needed are removed.
+        """
+        # Intern every name that appears in the graph, not just those of
+        # bundled modules, so that the conversion is lossless.
+        names = set(self.modules)
+        for moddata in self.modules.itervalues():
+            names.update(moddata.get("imports", ()))
+        for packdata in self.packs.itervalues():
+            names.update(packdata["modules"])
+        names = sorted(names)
+        ids = dict((name, i) for i, name in enumerate(names))
+        root_modules = {}
+        shard_modules = {}
+        for name, moddata in self.modules.iteritems():
+            moddata = moddata.copy()
+            if "imports" in moddata:
+                moddata["imports"] = [ids[dep] for dep in moddata["imports"]]
+            topname = name.split(".", 1)[0]
+            if name in self.preload or "dir" not in self.modules.get(topname, ()):
+                root_modules[str(ids[name])] = moddata
+            else:
+                shard_modules.setdefault(topname, {})[str(ids[name])] = moddata
+        index = {
+            "names": names,
+            "modules": root_modules,
+            "shards": {},
+            "preload_pack": {"file": "preload.json"},
+        }
+        shards_dir = os.path.join(self.bundle_dir, "shards")
+        if shard_modules and not os.path.isdir(shards_dir):
+            os.makedirs(shards_dir)
+        for topname, modules in shard_modules.iteritems():
+            index["shards"][topname] = {"file": "shards/" + topname + ".json"}
+            with open(os.path.join(shards_dir, topname + ".json"), "w") as f:
+                json.dump({"modules": modules}, f,
+                          sort_keys=True, separators=(",", ":"))
+        if os.path.isdir(shards_dir):
+            for nm in os.listdir(shards_dir):
+                if nm[:-len(".json")] not in shard_modules:
+                    os.unlink(os.path.join(shards_dir, nm))
+        with open(os.path.join(self.bundle_dir, "preload.json"), "w") as f:
+            json.dump({
+                "modules": self.preload,
+                "bytecode": self.preload_bytecode,
+            }, f, sort_keys=True, separators=(",", ":"))
+        if self.hash_names:
+            for filedata in index["shards"].values() + [index["preload_pack"]]:
+                filepath = os.path.join(self.bundle_dir, filedata["file"])
+                filedata["url"] = self._copy_hashed_file(filepath)
+        if self.files:
+            index["files"] = self.files
+        if self.packs:
+            index["packs"] = {}
+            for packname, packdata in self.packs.iteritems():
+                packdata = packdata.copy()
+                packdata["modules"] = [ids[nm] for nm in packdata["modules"]]
+                index["packs"][packname] = packdata
+        return index
+
+    def _read_split_index_files(self, index):
+        """Convert a split index back into the in-memory format."""
+        names = index["names"]
+        entries = [index["modules"]]
+        for shard in index["shards"].itervalues():
+            with open(os.path.join(self.bundle_dir, shard["file"])) as f:
+                entries.append(json.load(f)["modules"])
+        modules = {}
+        for shard_modules in entries:
+            for key, moddata in shard_modules.iteritems():
+                if "imports" in moddata:
+                    moddata["imports"] = [names[i] for i in moddata["imports"]]
+                modules[names[int(key)]] = moddata
+        with open(os.path.join(self.bundle_dir,
+                               index["preload_pack"]["file"])) as f:
+            preload = json.load(f)
+        packs = index.get("packs", {})
+        for packdata in packs.itervalues():
+            packdata["modules"] = [names[i] for i in packdata["modules"]]
+        return {
+            "modules": modules,
+            "preload": preload["modules"],
+            "preload_bytecode": preload["bytecode"],
+            "files": index.get("files", {}),
+            "packs": packs,
+        }
 
     def load_index(self):
         """Load in-memory state from the index file."""
         with open(self.index_file) as f:
             index = json.load(f)
+        if "names" in index:
+            index = self._read_split_index_files(index)
         self.modules = index["modules"]
         self.preload = index["preload"]
+        self.preload_bytecode = index.get("preload_bytecode", {})
+        self.files = index.get("files", {})
+        self.packs = index.get("packs", {})
         with open(self.meta_file) as f:
             meta = json.load(f)
         self.exclude = meta["exclude"]
+        self.bytecode_magic = meta.get("bytecode_magic")
+        self.hash_names = meta.get("hash_names", False)
+        self.split_index = meta.get("split_index", False)
+        self.minify = meta.get("minify", False)
+        self.minify_docstrings = meta.get("minify_docstrings", True)
         self.missing = meta["missing"]
+        self._exclude_set = set(self.exclude)
+        self._missing_index = {}
+        for depname in self.missing:
+            self._index_missing(depname)
+        self.sources = meta.get("sources", {})
+
+    def enable_bytecode(self, magic=None):
+        """Enable compilation of bundled modules to .pyc files.
+
+        The magic number must match that of the target VM, or it will ignore
+        the .pyc files.  By default we use the magic number of the running
+        interpreter.  The bytecode itself is always that of the running
+        interpreter, so this must be a PyPy; an explicit magic number only
+        helps when it's a PyPy of a slightly different version.
+        """
+        _check_bytecode_compiler()
+        if magic is None:
+            magic = imp.get_magic().encode("hex")
+        else:
+            try:
+                if len(binascii.unhexlify(magic)) != 4:
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise ValueError("bytecode magic must be 4 bytes of hex")
+        self.bytecode_magic = magic.lower()
 
     def is_dotted_prefix(self, prefix, name):
         """Check whether a dotted name is a prefix of another."""
@@ -407,18 +998,68 @@ class ModuleBundle(object):
 
     def is_builtin(self, name):
         """Check whether the named module is a builtin."""
-        for builtin in BUILTIN_MODULES:
-            if self.is_dotted_prefix(builtin, name):
+        for prefix in _dotted_prefixes(name):
+            if prefix in self._builtin_set:
                 return True
         return False
 
     def is_excluded(self, name):
         """Check whether the named module should be excluded."""
-        for excl in self.exclude:
-            if self.is_dotted_prefix(excl, name):
+        for prefix in _dotted_prefixes(name):
+            if prefix in self._exclude_set:
                 return True
         return False
 
+    def exclude_module(self, name):
+        """Add the named module to the list of excluded modules."""
+        self.exclude.append(name)
+        self._exclude_set.add(name)
+
+    def include_module(self, name):
+        """Remove the named module from the list of excluded modules."""
+        self.exclude.remove(name)
+        if name not in self.exclude:
+            self._exclude_set.discard(name)
+
+    def _index_missing(self, depname):
+        """Add a missing module name to the index of missing names.
+
+        The index maps each dotted prefix of a missing name to the set of
+        missing names that it is a prefix of, so we can quickly find all the
+        missing imports that are resolved by a newly-bundled module.
+        """
+        for prefix in _dotted_prefixes(depname):
+            try:
+                self._missing_index[prefix].add(depname)
+            except KeyError:
+                self._missing_index[prefix] = set((depname,))
+
+    def _add_missing(self, depname, modname):
+        """Record that a module imports a name missing from the bundle."""
+        if depname not in self.missing:
+            self.missing[depname] = []
+            self._index_missing(depname)
+        self.missing[depname].append(modname)
+
+    def _pop_missing(self, modname):
+        """Remove and return all missing names resolved by a module.
+
+        This returns a list of (depname, revdeps) pairs, for each missing
+        name that has the given module name as a dotted prefix.
+        """
+        depnames = self._missing_index.get(modname)
+        if not depnames:
+            return []
+        resolved = []
+        for depname in sorted(depnames):
+            resolved.append((depname, self.missing.pop(depname)))
+            for prefix in _dotted_prefixes(depname):
+                prefixed = self._missing_index[prefix]
+                prefixed.discard(depname)
+                if not prefixed:
+                    del self._missing_index[prefix]
+        return resolved
+
     def bundle_module(self, filepath):
         """Bundle the given file as a python module."""
         filepath = os.path.abspath(filepath)
@@ -436,6 +1077,10 @@ class ModuleBundle(object):
     def bundle_directory(self, dirpath):
         """Bundle all modules/packages in the given directory."""
         dirpath = os.path.abspath(dirpath)
+        # Get the workers parsing everything up-front, so they can run
+        # ahead of the gathering and analysis of each individual item.
+        if self.jobs > 1:
+            self._schedule_directory_scans(dirpath)
         for nm in os.listdir(dirpath):
             nm = _u(nm)
             if nm.startswith("."):
@@ -475,11 +1120,20 @@ class ModuleBundle(object):
             # Add it to the list of available modules.
             moddata = {"file": relpath.replace("\\", "/")}
             self.modules[modname] = moddata
-            # Copy its source file across.
-            self._copy_py_file(os.path.join(rootdir, relpath),
-                               os.path.join(self.bundle_dir, relpath))
+            # Copy its source file across, if it has changed.
+            srcpath = os.path.join(rootdir, relpath)
+            self._update_py_file(srcpath, relpath)
+            # Compile it to bytecode, if requested.
+            if self.bytecode_magic is not None:
+                mtime = self._compile_py_file(relpath)
+                if mtime is not None:
+                    moddata["pyc"] = moddata["file"] + "c"
+                    moddata["mtime"] = mtime
             # We'll need to analyse its imports once all siblings are gathered.
             self._modules_pending_import_analysis.append(modname)
+            if self.jobs > 1 and not self._has_scanned_imports(moddata["file"]):
+                self._module_srcpaths[modname] = srcpath
+                self._schedule_import_scan(srcpath)
 
     def _gather_package(self, package, rootdir, relpath):
         """Recursively gather a python package directory into the bundle.
@@ -513,13 +1167,103 @@ class ModuleBundle(object):
                 elif nm.endswith(".py"):
                     self._gather_module(subpackage, rootdir, subrelpath)
 
+    def _schedule_import_scan(self, srcpath):
+        """Start parsing a source file for imports in a worker process."""
+        if srcpath not in self._import_scans:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.jobs)
+            result = self._pool.apply_async(_scan_imports, (srcpath,))
+            self._import_scans[srcpath] = result
+
+    def _schedule_directory_scans(self, dirpath, package="", reldir=""):
+        """Start parsing all module files that will be gathered from a dir.
+
+        This follows the same rules as the gathering methods for deciding
+        what is a module or a package, so we don't waste time parsing files
+        that will never make it into the bundle.
+        """
+        for nm in sorted(os.listdir(dirpath)):
+            nm = _u(nm)
+            if nm.startswith("."):
+                continue
+            itempath = os.path.join(dirpath, nm)
+            if os.path.isdir(itempath):
+                if os.path.exists(os.path.join(itempath, "__init__.py")):
+                    subpackage = package + "." + nm if package else nm
+                    if not self.is_excluded(subpackage):
+                        self._schedule_directory_scans(
+                            itempath, subpackage, os.path.join(reldir, nm))
+            elif nm.endswith(".py"):
+                modname = package + "." + nm[:-3] if package else nm[:-3]
+                if not self.is_excluded(modname):
+                    relpath = os.path.join(reldir, nm)
+                    if not self._is_source_unchanged(itempath, relpath):
+                        self._schedule_import_scan(itempath)
+
+    def _is_source_unchanged(self, srcpath, relpath):
+        """Cheaply check whether a source file is unchanged since bundling.
+
+        This only compares the file's path, size and mtime against those
+        recorded in the "sources" metadata, and is used to avoid reading
+        the file at all in the common case.
+        """
+        info = self.sources.get(relpath.replace("\\", "/"))
+        if info is None or info["path"] != srcpath:
+            return False
+        if info.get("minified", False) != self._minified_marker():
+            return False
+        if not os.path.exists(os.path.join(self.bundle_dir, relpath)):
+            return False
+        st = os.stat(srcpath)
+        return info["mtime"] == st.st_mtime and info["size"] == st.st_size
+
+    def _has_scanned_imports(self, relpath):
+        """Check whether we have cached import scan results for a file."""
+        info = self.sources.get(relpath)
+        return info is not None and "scanned_imports" in info
+
+    def _update_py_file(self, srcpath, relpath):
+        """Copy a python source file into the bundle, unless it's unchanged.
+
+        If the file's mtime does not match the one recorded in the "sources"
+        metadata then we check the hash of its contents, so that touching a
+        file without changing it does not cause it to be re-processed.
+        """
+        key = relpath.replace("\\", "/")
+        dstpath = os.path.join(self.bundle_dir, relpath)
+        if self._is_source_unchanged(srcpath, relpath):
+            return
+        with open(srcpath, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        st = os.stat(srcpath)
+        info = self.sources.get(key)
+        if info is None or info["hash"] != digest or \
+           info.get("minified", False) != self._minified_marker() or \
+           not os.path.exists(dstpath):
+            self._copy_py_file(srcpath, dstpath)
+            info = self.sources[key] = {"hash": digest}
+            if self.minify:
+                info["minified"] = self._minified_marker()
+        info["path"] = srcpath
+        info["mtime"] = st.st_mtime
+        info["size"] = st.st_size
+
+    def _minified_marker(self):
+        """Get the value recorded in "sources" for how a file was minified."""
+        if not self.minify:
+            return False
+        if not self.minify_docstrings:
+            return "keep-docstrings"
+        return True
+
     def _copy_py_file(self, srcpath, dstpath):
         """Copy a python source file into the bundle.
 
         This method copes the contents of a python source file into the bundle.
         Since browsers usually expect strings in utf-8 format, it will try to
         detect source files in other encodings and transparently convert them
-        to utf-8.
+        to utf-8.  If minification is enabled for the bundle then comments
+        and docstrings are also stripped out.
         """
         # XXX TODO: copy in chunks, like shutil would do?
         with open(srcpath, "rb") as f_src:
@@ -539,20 +1283,59 @@ class ModuleBundle(object):
                     except LookupError:
                         encoding = None
                     break
+        # Normalize the data to utf-8.
+        if encoding is not None:
+            f_data = StringIO()
+            for j in xrange(i):
+                f_data.write(lines[j])
+                f_data.write("\n")
+            f_data.write(lines[i].replace(encoding, "utf-8"))
+            f_data.write("\n")
+            for j in xrange(i + 1, len(lines)):
+                f_data.write(lines[j].decode(encoding).encode("utf8"))
+                if j < len(lines) - 1:
+                    f_data.write("\n")
+            data = f_data.getvalue()
+        if self.minify:
+            minified = _minify_source(data, dstpath,
+                                      not self.minify_docstrings)
+            relpath = os.path.relpath(dstpath, self.bundle_dir)
+            self.minified_sizes[relpath] = (len(data), len(minified))
+            data = minified
         # Write normalized data to output file.
         with open(dstpath, "wb") as f_dst:
-            if encoding is None:
-                f_dst.write(data)
-            else:
-                for j in xrange(i):
-                    f_dst.write(lines[j])
-                    f_dst.write("\n")
-                f_dst.write(lines[i].replace(encoding, "utf-8"))
-                f_dst.write("\n")
-                for j in xrange(i + 1, len(lines)):
-                    f_dst.write(lines[j].decode(encoding).encode("utf8"))
-                    if j < len(lines) - 1:
-                        f_dst.write("\n")
+            f_dst.write(data)
+
+    def _compile_py_file(self, relpath):
+        """Compile a python source file in the bundle to a .pyc file.
+
+        The code is compiled with the filename that it will have inside the
+        VM, so that tracebacks point to the right place.  This returns the
+        mtime recorded in the .pyc file, or None if it failed to compile.
+        """
+        _check_bytecode_compiler()
+        srcpath = os.path.join(self.bundle_dir, relpath)
+        pycpath = srcpath + "c"
+        mtime = int(os.stat(srcpath).st_mtime)
+        header = self.bytecode_magic.decode("hex") + struct.pack("<I", mtime)
+        # Skip it if there's an up-to-date .pyc file already.
+        if os.path.exists(pycpath):
+            with open(pycpath, "rb") as f:
+                if f.read(len(header)) == header:
+                    return mtime
+        with open(srcpath, "rb") as f:
+            source = f.read()
+        filename = "/lib/pypyjs/lib_pypy/" + relpath.replace("\\", "/")
+        try:
+            code = compile(source, filename, "exec", 0, True)
+        except (SyntaxError, TypeError, ValueError):
+            if os.path.exists(pycpath):
+                os.unlink(pycpath)
+            return None
+        with open(pycpath, "wb") as f:
+            f.write(header)
+            marshal.dump(code, f)
+        return mtime
 
     def _perform_pending_import_analysis(self):
         """Perform import analysis on any pending modules.
@@ -564,31 +1347,89 @@ class ModuleBundle(object):
         """
         while self._modules_pending_import_analysis:
             modname = self._modules_pending_import_analysis.pop()
-            # Check if this new module resolves previously-missing imports.
-            # XXX TODO: this is pretty ugly and inefficient...
-            for depname in self.missing.keys():
-                if self.is_dotted_prefix(modname, depname):
-                    revdeps = self.missing.pop(depname)
-                    for revdepname in revdeps:
-                        revdepdata = self.modules[revdepname]
-                        revdepdata["imports"].remove(depname)
-                        if modname not in revdepdata["imports"]:
-                            revdepdata["imports"].append(modname)
+            self._resolve_missing(modname)
             # Find all the names that it imports.
             moddata = self.modules[modname]
             if "file" not in moddata:
                 continue
             modpath = os.path.join(self.bundle_dir, moddata["file"])
-            impf = ImportFinder(modname, modpath, self.modules)
+            scanned = self._get_scanned_imports(modname, moddata["file"])
+            impf = ImportFinder(modname, modpath, self.modules, scanned)
             moddata["imports"] = impf.find_imported_modules()
             # Check for any imports that are missing from the bundle.
             for depname in moddata["imports"]:
                 if depname not in self.modules:
                     if not self.is_excluded(depname):
                         if not self.is_builtin(depname):
-                            if depname not in self.missing:
-                                self.missing[depname] = []
-                            self.missing[depname].append(modname)
+                            self._add_missing(depname, modname)
+
+    def _resolve_missing(self, modname):
+        """Check if a new module resolves previously-missing imports."""
+        for depname, revdeps in self._pop_missing(modname):
+            for revdepname in revdeps:
+                revdepdata = self.modules[revdepname]
+                revdepdata["imports"].remove(depname)
+                if modname not in revdepdata["imports"]:
+                    revdepdata["imports"].append(modname)
+
+    def copy_module(self, other, name):
+        """Copy a module's files and metadata from another bundle.
+
+        The module's imports are taken as already resolved in the other
+        bundle, so it's up to the caller to copy across its dependencies.
+        """
+        moddata = other.modules[name].copy()
+        if "imports" in moddata:
+            moddata["imports"] = list(moddata["imports"])
+        if "dir" in moddata:
+            dirpath = os.path.join(self.bundle_dir, moddata["dir"])
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+        if "file" in moddata:
+            filepath = os.path.join(self.bundle_dir, moddata["file"])
+            dirpath = os.path.dirname(filepath)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            if name in other.preload:
+                with open(filepath, "w") as f:
+                    f.write(other.preload[name].encode("utf8"))
+                if "mtime" in moddata:
+                    os.utime(filepath, (moddata["mtime"], moddata["mtime"]))
+            else:
+                shutil.copy2(os.path.join(other.bundle_dir, moddata["file"]),
+                             filepath)
+            if moddata["file"] in other.sources:
+                self.sources[moddata["file"]] = other.sources[moddata["file"]]
+        if "pyc" in moddata:
+            filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+            if name in other.preload_bytecode:
+                with open(filepath, "wb") as f:
+                    f.write(base64.b64decode(other.preload_bytecode[name]))
+            else:
+                shutil.copy2(os.path.join(other.bundle_dir, moddata["pyc"]),
+                             filepath)
+        self.modules[name] = moddata
+        self._resolve_missing(name)
+
+    def _get_scanned_imports(self, modname, relpath):
+        """Get the raw imported names for a module file in the bundle.
+
+        This uses the cached results from a previous run if the file is
+        unchanged, or the results from a worker process if one was asked to
+        scan it, and only falls back to scanning it here as a last resort.
+        """
+        srcpath = self._module_srcpaths.pop(modname, None)
+        info = self.sources.get(relpath)
+        if info is not None and "scanned_imports" in info:
+            return info["scanned_imports"]
+        if srcpath is not None and srcpath in self._import_scans:
+            scanned = self._import_scans.pop(srcpath).get()
+        else:
+            modpath = os.path.join(self.bundle_dir, relpath)
+            scanned = ImportScanner(modpath).scan_imported_names()
+        if info is not None:
+            info["scanned_imports"] = scanned
+        return scanned
 
     def preload_module(self, name):
         """Preload a module's file data into the index itself.
@@ -606,14 +1447,131 @@ class ModuleBundle(object):
                 filepath = os.path.join(self.bundle_dir, moddata["file"])
                 with open(filepath, "r") as f:
                     self.preload[depname] = f.read()
+            if "pyc" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                with open(filepath, "rb") as f:
+                    self.preload_bytecode[depname] = base64.b64encode(f.read())
 
-    def _find_transitive_dependencies(self, name, seen=None):
-        """Transitively find all dependencies of a module."""
-        if seen is None:
-            seen = set((name,))
+    def pack_module(self, name):
+        """Pack a module together with all of its dependencies.
+
+        The pack is named after the module, and will be used when loading
+        the module would otherwise require fetching all of its contents.
+        """
+        modules = self._find_transitive_dependencies(name)
+        self._add_pack(name, modules)
+
+    def pack_cycles(self):
+        """Pack each group of modules that transitively import each other.
+
+        These are the strongly-connected components of the import graph.
+        Importing any module in such a group means loading all of them, so
+        they might as well be fetched together.
+        """
+        for component in self._find_strongly_connected_components():
+            if len(component) > 1:
+                self._add_pack("cycle-" + min(component), component)
+
+    def _add_pack(self, packname, modules):
+        """Add or replace a pack containing the given modules."""
+        modules = sorted(name for name in modules
+                         if "file" in self.modules.get(name, ())
+                         and name not in self.preload)
+        if len(modules) > 1:
+            self.packs[packname] = {
+                "file": "packs/" + packname + ".json",
+                "modules": modules,
+            }
+
+    def unpreload_module(self, name):
+        """Stop preloading a module, and restore its file data to disk."""
+        moddata = self.modules.get(name)
+        if moddata is not None and name in self.preload:
+            if "file" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["file"])
+                with open(filepath, "w") as f:
+                    f.write(self.preload[name].encode("utf8"))
+                # Keep any compiled bytecode valid for the restored file.
+                if "mtime" in moddata:
+                    os.utime(filepath, (moddata["mtime"], moddata["mtime"]))
+            if name in self.preload_bytecode:
+                filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                with open(filepath, "wb") as f:
+                    f.write(base64.b64decode(self.preload_bytecode[name]))
+        self.preload.pop(name, None)
+        self.preload_bytecode.pop(name, None)
+
+    def preload_from_traces(self, traces, budget):
+        """Replace the set of preloaded modules based on recorded traces.
+
+        Each trace is a list of module names in the order they were loaded
+        during a real session.  Modules are ranked by how many traces they
+        appear in, then by how early they appear on average, and preloaded
+        along with their dependencies in that order for as long as the total
+        size of preloaded files stays within the given budget.  The default
+        preload modules, including those needed to start up the VM, are
+        always preloaded.
+        """
+        counts = {}
+        positions = {}
+        for trace in traces:
+            seen = set()
+            for i, name in enumerate(trace):
+                if name in self.modules and name not in seen:
+                    seen.add(name)
+                    counts[name] = counts.get(name, 0) + 1
+                    positions.setdefault(name, []).append(float(i) / len(trace))
+        ranked = sorted(counts, key=lambda name: (
+            -counts[name], sum(positions[name]) / len(positions[name]), name
+        ))
+        # Work out the size of each module's files before we go changing
+        # what is preloaded, since that will move data on and off disk.
+        sizes = {}
+        for name in self.modules:
+            sizes[name] = self._get_preload_size(name)
+        for name in list(self.preload):
+            self.unpreload_module(name)
+        selected = set()
+        for name in PRELOAD_MODULES:
+            selected.update(self._find_transitive_dependencies(name))
+        total = sum(sizes.get(name, 0) for name in selected)
+        for name in ranked:
+            deps = self._find_transitive_dependencies(name) - selected
+            cost = sum(sizes.get(dep, 0) for dep in deps)
+            if total + cost <= budget:
+                selected.update(deps)
+                total += cost
+        for name in sorted(selected):
+            if name in self.modules:
+                self.preload_module(name)
+
+    def _get_preload_size(self, name):
+        """Get the number of bytes that preloading a module would take.
+
+        Preloaded bytecode is stored base64-encoded in the index, so it is
+        counted at its encoded size whether or not it's preloaded already.
+        """
+        moddata = self.modules[name]
+        size = 0
+        if name in self.preload:
+            size += len(self.preload[name].encode("utf8"))
+            size += len(self.preload_bytecode.get(name, ""))
+        else:
+            if "file" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["file"])
+                if os.path.exists(filepath):
+                    size += os.path.getsize(filepath)
+            if "pyc" in moddata:
+                filepath = os.path.join(self.bundle_dir, moddata["pyc"])
+                if os.path.exists(filepath):
+                    size += _base64_size(os.path.getsize(filepath))
+        return size
+
+    def _find_direct_dependencies(self, name):
+        """Find the modules that must be loaded along with a module."""
+        deps = set()
         moddata = self.modules.get(name)
         if moddata is not None:
-            deps = set()
             imports = moddata.get("imports")
             if imports is not None:
                 deps.update(imports)
@@ -621,29 +1579,213 @@ class ModuleBundle(object):
                 deps.add(name + ".__init__")
             if "." in name:
                 deps.add(name.rsplit(".", 1)[0])
+        return deps
+
+    def _find_transitive_dependencies(self, name, seen=None):
+        """Transitively find all dependencies of a module."""
+        if seen is None:
+            seen = set((name,))
+        moddata = self.modules.get(name)
+        if moddata is not None:
+            deps = self._find_direct_dependencies(name)
             seen.add(name)
             for dep in deps:
                 if dep not in seen:
                     self._find_transitive_dependencies(dep, seen)
         return seen
 
+    def _find_strongly_connected_components(self):
+        """Find strongly-connected components of the dependency graph.
 
-class ImportFinder(ast.NodeVisitor):
-    """An AST NodeVisitor for finding all names imported in a python file."""
+        This is Tarjan's algorithm, done iteratively so that long chains
+        of dependencies don't blow the recursion limit.
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        onstack = set()
+        components = []
+        for root in sorted(self.modules):
+            if root in index:
+                continue
+            work = [(root, None)]
+            while work:
+                name, deps = work[-1]
+                if deps is None:
+                    index[name] = lowlink[name] = len(index)
+                    stack.append(name)
+                    onstack.add(name)
+                    deps = sorted(dep for dep in
+                                  self._find_direct_dependencies(name)
+                                  if dep in self.modules)
+                    deps = iter(deps)
+                    work[-1] = (name, deps)
+                for dep in deps:
+                    if dep not in index:
+                        work.append((dep, None))
+                        break
+                    if dep in onstack:
+                        lowlink[name] = min(lowlink[name], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[name])
+                    if lowlink[name] == index[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            onstack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        components.append(component)
+        return components
 
-    def __init__(self, module, filepath, known_modules):
-        super(ImportFinder, self).__init__()
-        self.module = module
-        if "." in module:
-            self.package = module.rsplit(".", 1)[0]
-        else:
-            self.package = ""
+
+def _dotted_prefixes(name):
+    """Iterate over each dotted prefix of a name, including the name itself."""
+    idx = name.find(".")
+    while idx != -1:
+        yield name[:idx]
+        idx = name.find(".", idx + 1)
+    yield name
+
+
+def _check_bytecode_compiler():
+    """Check that the running interpreter can compile bytecode for the VM.
+
+    CPython bytecode won't run in PyPy even if it carries PyPy's magic
+    number, so .pyc files can only be produced when running under PyPy.
+    """
+    if "__pypy__" not in sys.builtin_module_names:
+        raise ValueError("bytecode must be compiled by running this "
+                         "script with pypy")
+
+
+def _file_digest(filepath):
+    """Get the hash used to name the content-addressed copy of a file."""
+    with open(filepath, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:20]
+
+
+def _base64_size(size):
+    """Get the length of the base64 encoding of this many bytes."""
+    return (size + 2) // 3 * 4
+
+
+def _minify_source(source, filepath, keep_docstrings=False):
+    """Strip comments and docstrings from python source code.
+
+    Indentation is reduced to a single space per level and runs of
+    whitespace between tokens are collapsed, but each token stays on the
+    same line as in the original, so that line numbers in tracebacks still
+    match up.  Docstrings are kept if requested, or if the code mentions
+    "__doc__" or a module that reads docstrings, since it may be relying on
+    them.  Encoding declarations are kept.  If anything goes wrong then the
+    original source is returned unchanged.
+    """
+    if not keep_docstrings:
+        for name in DOCSTRING_READERS:
+            if name in source:
+                keep_docstrings = True
+                break
+    output = []
+    row = 1
+    indent = 0
+    brackets = 0
+    # The type of the previous token that we didn't skip over entirely,
+    # which tells us whether a string would be a docstring.
+    prev_type = None
+    # The type and end position of the previous token in the source.
+    last_type = tokenize.NEWLINE
+    last_end = (1, 0)
+    try:
+        tokens = list(tokenize.generate_tokens(StringIO(source).readline))
+        for i, (toktype, tokstr, start, end, _) in enumerate(tokens):
+            if toktype == tokenize.INDENT:
+                indent += 1
+                prev_type = toktype
+                continue
+            if toktype == tokenize.DEDENT:
+                indent -= 1
+                continue
+            if toktype == tokenize.COMMENT:
+                # Only encoding declarations are significant.
+                if start[0] > 2 or not re.search(r"coding[:=]\s*([-\w.]+)",
+                                                 tokstr):
+                    continue
+            if toktype == tokenize.STRING and prev_type in (None,
+                                                            tokenize.INDENT):
+                # A string statement at the start of a block is a docstring.
+                # Those in a module can just be removed, but those in a
+                # function or class must leave a statement in their place.
+                j = i
+                while tokens[j][0] == tokenize.STRING:
+                    j += 1
+                if tokens[j][0] == tokenize.NEWLINE and not keep_docstrings:
+                    del tokens[i + 1:j]
+                    if prev_type is None:
+                        prev_type = tokenize.NEWLINE
+                        continue
+                    toktype, tokstr = tokenize.NAME, "pass"
+                    end = (start[0], start[1] + 4)
+            if toktype in (tokenize.NL, tokenize.NEWLINE, tokenize.ENDMARKER):
+                tokstr = ""
+            # Move to the line on which the token starts.
+            if start[0] > row:
+                if last_type not in (tokenize.NL, tokenize.NEWLINE,
+                                     tokenize.COMMENT) and \
+                   last_end[0] < start[0]:
+                    # The line was continued with a backslash.
+                    output.append("\\")
+                output.append("\n" * (start[0] - row))
+                row = start[0]
+                if last_type in (tokenize.NEWLINE, tokenize.NL) and \
+                   brackets == 0 and tokstr:
+                    output.append(" " * indent)
+            elif start != last_end and output and tokstr:
+                output.append(" ")
+            output.append(tokstr)
+            if toktype == tokenize.OP:
+                if tokstr in "([{":
+                    brackets += 1
+                elif tokstr in ")]}":
+                    brackets -= 1
+            row = end[0]
+            last_type = toktype
+            last_end = end
+            if toktype not in (tokenize.NL, tokenize.COMMENT):
+                prev_type = toktype
+        minified = "".join(output)
+        compile(minified, filepath, "exec", 0, True)
+    except (tokenize.TokenError, IndentationError, SyntaxError, TypeError,
+            ValueError):
+        return source
+    return minified
+
+
+def _scan_imports(filepath):
+    """Parse a python file for raw imported names, in a worker process."""
+    return ImportScanner(filepath).scan_imported_names()
+
+
+class ImportScanner(ast.NodeVisitor):
+    """An AST NodeVisitor for finding raw import statements in a python file.
+
+    This does the expensive part of import analysis, reading and parsing
+    the file, without needing any knowledge of the other modules in the
+    bundle.  Each imported name is recorded in the order it appears, along
+    with whether "from __future__ import absolute_import" was in effect.
+    """
+
+    def __init__(self, filepath):
+        super(ImportScanner, self).__init__()
         self.filepath = filepath
-        self.known_modules = known_modules
-        self.imported_names = set()
+        self.scanned_names = []
         self.uses_absolute_import = False
 
-    def find_imported_modules(self):
+    def scan_imported_names(self):
         with open(self.filepath, "r") as f:
             code = f.read()
         try:
@@ -651,11 +1793,11 @@ class ImportFinder(ast.NodeVisitor):
         except SyntaxError:
             return []
         self.visit(n)
-        return sorted(list(self.imported_names))
+        return self.scanned_names
 
     def visit_Import(self, node):
         for alias in node.names:
-            self.record_imported_name(alias.name)
+            self.scanned_names.append((alias.name, self.uses_absolute_import))
 
     def visit_ImportFrom(self, node):
         if node.module == "__future__":
@@ -666,7 +1808,39 @@ class ImportFinder(ast.NodeVisitor):
         if node.module is not None:
             prefix += node.module + "."
         for alias in node.names:
-            self.record_imported_name(prefix + alias.name)
+            self.scanned_names.append((prefix + alias.name,
+                                       self.uses_absolute_import))
+
+
+class ImportFinder(object):
+    """Class for finding all module names imported in a python file.
+
+    The raw names are found with an ImportScanner, unless the results of
+    a previous scan are provided, and are then resolved to the names of
+    known modules in the bundle.
+    """
+
+    def __init__(self, module, filepath, known_modules, scanned_names=None):
+        super(ImportFinder, self).__init__()
+        self.module = module
+        if "." in module:
+            self.package = module.rsplit(".", 1)[0]
+        else:
+            self.package = ""
+        self.filepath = filepath
+        self.known_modules = known_modules
+        self.scanned_names = scanned_names
+        self.imported_names = set()
+        self.uses_absolute_import = False
+
+    def find_imported_modules(self):
+        scanned_names = self.scanned_names
+        if scanned_names is None:
+            scanned_names = ImportScanner(self.filepath).scan_imported_names()
+        for name, uses_absolute_import in scanned_names:
+            self.uses_absolute_import = uses_absolute_import
+            self.record_imported_name(name)
+        return sorted(list(self.imported_names))
 
     def record_imported_name(self, name):
         # Dereference explicit relative imports indicated by leading dots.